@@ -15,7 +15,7 @@ class CustomUserAdmin(UserAdmin):
         (None, {'fields': ('email', 'password')}),
         ('Personal info', {'fields': ('first_name', 'last_name')}),
         ('other info', {'fields': ('phone', 'address',
-                                   'id_number', 'is_admin', 'image')}),
+                                   'id_number', 'is_admin', 'admin_digest', 'image')}),
     )
 
     add_fieldsets = (
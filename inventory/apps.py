@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class InventoryConfig(AppConfig):
@@ -6,4 +7,7 @@ class InventoryConfig(AppConfig):
     verbose_name = 'Inventory Application'
 
     def ready(self):
-        import inventory.signals
\ No newline at end of file
+        import inventory.signals
+        from inventory.caching import check_shared_cache
+
+        checks.register(check_shared_cache)
@@ -0,0 +1,127 @@
+"""Helpers for values kept in the shared cache"""
+import threading
+import time
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+
+
+# Cache backends keeping values inside a single process
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+# Namespaces bumped inside a transaction by the current thread, bumped again once it ended
+_pending = threading.local()
+
+
+def generation_key(namespace):
+    """Cache key holding the generation of a namespace"""
+    return 'generation:{0}'.format(namespace)
+
+
+def get_generation(namespace):
+    """
+    Current generation of a namespace, keys built with it change
+    whenever the namespace is bumped
+    """
+    key = generation_key(namespace)
+    generation = cache.get(key)
+
+    if generation is None:
+        # Starting from the clock so an evicted counter never repeats an old generation
+        cache.add(key, int(time.time() * 1000), None)
+        generation = cache.get(key)
+
+    return generation
+
+
+def _bump(namespace):
+    """Increment the generation of a namespace"""
+    key = generation_key(namespace)
+
+    try:
+        cache.incr(key)
+
+    except ValueError:
+        get_generation(namespace)
+
+
+def bump_generation(namespace):
+    """
+    Move a namespace to a new generation, orphaning everything cached under
+    the old one. Inside a transaction, values read before it commits would be
+    cached under the new generation, so the namespace is bumped again by
+    bump_pending_generations once the transaction ended.
+    """
+    _bump(namespace)
+
+    if transaction.get_connection().in_atomic_block:
+        if getattr(_pending, 'namespaces', None) is None:
+            _pending.namespaces = set()
+
+        _pending.namespaces.add(namespace)
+
+
+def bump_pending_generations():
+    """Bump again the namespaces bumped inside transactions, once they ended"""
+    namespaces = getattr(_pending, 'namespaces', None)
+    _pending.namespaces = None
+
+    for namespace in namespaces or ():
+        _bump(namespace)
+
+
+def counter_key(name):
+    """Cache key holding a counter"""
+    return 'counter:{0}'.format(name)
+
+
+def increment_counter(name, amount=1):
+    """Increment a counter kept in the shared cache"""
+    key = counter_key(name)
+
+    if not cache.add(key, amount, None):
+        try:
+            cache.incr(key, amount)
+
+        except ValueError:
+            cache.set(key, amount, None)
+
+
+def get_counter(name):
+    """Read a counter kept in the shared cache"""
+    return cache.get(counter_key(name), 0)
+
+
+def get_counters(names):
+    """Read many counters kept in the shared cache with one round trip"""
+    values = cache.get_many([counter_key(name) for name in names])
+    return dict((name, values.get(counter_key(name), 0)) for name in names)
+
+
+def dashboard_cache_version(scope):
+    """
+    Version of the cached dashboard tables of a scope, changes with the
+    provisions shown in the scope and with any item
+    """
+    return '{0}.{1}'.format(
+        get_generation('dashboard:{0}'.format(scope)),
+        get_generation('dashboard:items')
+    )
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """Warn when the default cache is not shared by the web and worker processes"""
+    if settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES:
+        return []
+
+    return [checks.Warning(
+        'The default cache is kept in each process',
+        hint='Invalidations of reports, dashboards and admin recipients and task metrics '
+             'only reach the process making them, use a cache shared by all processes.',
+        id='inventory.W001',
+    )]
@@ -0,0 +1,91 @@
+"""Admin recipients of notifications, and the digest of admins taking one summary mail instead of a cc on each"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+
+from inventory.caching import get_generation
+from inventory.message_constants import admin_digest_mail
+from inventory.models import User, AdminEvent, OutboundMail
+
+
+def get_admins():
+    """
+    Emails of admins and whether they take the digest, kept in the shared
+    cache until a user is saved or deleted
+    """
+    key = 'admins:{0}'.format(get_generation('admins'))
+    admins = cache.get(key)
+
+    if admins is None:
+        admins = [
+            (str(email), admin_digest)
+            for email, admin_digest in User.objects.filter(is_admin=True).values_list('email', 'admin_digest')
+        ]
+        cache.set(key, admins, settings.ADMIN_RECIPIENTS_CACHE_TIMEOUT)
+
+    return admins
+
+
+def admin_emails():
+    """Emails of all admins"""
+    return [email for email, admin_digest in get_admins()]
+
+
+def admin_cc(kind, provisions):
+    """
+    Emails of admins to cc on a notification about provisions, the
+    notification is recorded for the digest of the other admins instead
+    """
+    cc_to = []
+    digest = False
+
+    for email, admin_digest in get_admins():
+        if admin_digest:
+            digest = True
+        else:
+            cc_to.append(email)
+
+    if digest:
+        AdminEvent.objects.bulk_create(
+            AdminEvent(kind=kind, item_id=provision.item_id, quantity=provision.quantity or 0)
+            for provision in provisions
+        )
+
+    return cc_to
+
+
+@transaction.atomic
+def flush_admin_digest():
+    """Queue one summary mail of the recorded events for every admin taking a digest, return their number"""
+    last_id = AdminEvent.objects.aggregate(last_id=Max('id'))['last_id']
+
+    if last_id is None:
+        return 0
+
+    # Events recorded while flushing wait for the next digest
+    events = AdminEvent.objects.filter(id__lte=last_id)
+    summary = events.values('kind', 'item__name').annotate(
+        count=Count('id'),
+        quantity=Sum('quantity')
+    ).order_by('kind', 'item__name')
+
+    kinds = dict(AdminEvent.KINDS)
+    new_mail = admin_digest_mail(
+        (kinds[row['kind']], row['item__name'], row['count'], row['quantity'])
+        for row in summary
+    )
+    emails = [email for email, admin_digest in get_admins() if admin_digest]
+
+    OutboundMail.objects.queue_many(
+        {
+            'subject': new_mail['subject'],
+            'body': new_mail['body'],
+            'to': [email],
+            'cc': []
+        }
+        for email in emails
+    )
+    events.delete()
+
+    return len(emails)
@@ -5,10 +5,13 @@ from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django import forms
 from django.db import transaction
 from django.forms.formsets import BaseFormSet
+from django.utils.functional import cached_property
 from inventory.message_constants import *
 
-from inventory.models import User, Item, Provision
-from inventory.signals import send_mail_signal
+from inventory.caching import bump_generation
+from inventory.digest import admin_cc, admin_emails
+from inventory.models import User, Item, Provision, DailyUsage, AdminEvent
+from inventory.signals import batched_mails, send_announcement_signal, send_mail_signal
 
 from datetimewidget.widgets import DateWidget
 
@@ -41,6 +44,7 @@ class CustomUserChangeForm(UserChangeForm):
             'address',
             'id_number',
             'is_admin',
+            'admin_digest',
             'image',
         )
 
@@ -93,10 +97,9 @@ class AddItemForm(forms.ModelForm):
             self.cleaned_data['name'],
             self.cleaned_data['quantity']
         )
-        recipients = [str(user.email) for user in User.objects.all()]
 
         instance = super(AddItemForm, self).save(commit=True)
-        send_mail_signal.send(sender=Item, mail_data=new_mail, recipients=recipients, cc_to=[])
+        send_announcement_signal.send(sender=Item, mail_data=new_mail)
         return instance
 
     def clean_name(self):
@@ -130,7 +133,7 @@ class EditItemForm(forms.ModelForm):
     def save(self, commit=True):
         """Sending email and saving the item"""
         new_mail = item_edited_mail(self.instance.name)
-        recipients = [str(user.email) for user in User.objects.filter(is_admin=True)]
+        recipients = admin_emails()
         instance = super(EditItemForm, self).save(commit=True)
         send_mail_signal.send(sender=Item, mail_data=new_mail, recipients=recipients, cc_to=[])
         return instance
@@ -158,9 +161,38 @@ class EditItemForm(forms.ModelForm):
         )
 
 
+class PrefetchedModelChoiceField(forms.ModelChoiceField):
+    """Model choice field resolving values from objects loaded once for a whole formset"""
+
+    def __init__(self, *args, **kwargs):
+        super(PrefetchedModelChoiceField, self).__init__(*args, **kwargs)
+
+        # Objects of the queryset by id, set by the formset before cleaning
+        self.prefetched = None
+
+    def to_python(self, value):
+        """Look the value up in prefetched objects instead of querying for it"""
+        if self.prefetched is None or value in self.empty_values:
+            return super(PrefetchedModelChoiceField, self).to_python(value)
+
+        try:
+            return self.prefetched[int(value)]
+
+        except (KeyError, ValueError, TypeError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+
 class ProvisionItemForm(forms.ModelForm):
     """Form to Provision an item"""
 
+    item = PrefetchedModelChoiceField(
+        queryset=Item.objects.exclude(quantity=0),
+        widget=autocomplete.ModelSelect2(url='item_autocomplete_ajax')
+    )
+    user = PrefetchedModelChoiceField(
+        queryset=User.objects.all(),
+        widget=autocomplete.ModelSelect2(url='user_autocomplete_ajax')
+    )
     quantity = forms.IntegerField(required=False)
     return_by = forms.DateTimeField(
         required=False,
@@ -174,8 +206,6 @@ class ProvisionItemForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super(ProvisionItemForm, self).__init__(*args, **kwargs)
-        self.fields['item'].queryset = self.fields[
-            'item'].queryset.exclude(quantity=0)
 
         # self.fields['user'].queryset = self.fields[
         #     'user'].queryset.exclude(is_admin=True)
@@ -187,6 +217,29 @@ class ProvisionItemForm(forms.ModelForm):
         self.fields['quantity'].widget.attrs['class'] = 'form-control'
         self.fields['return_by'].widget.attrs['class'] = 'form-control return-by'
 
+    def _get_validation_exclusions(self):
+        """
+        Foreign keys resolved from prefetched objects exist already, skip
+        the query model validation would make for each of them
+        """
+        exclude = super(ProvisionItemForm, self)._get_validation_exclusions()
+
+        exclude.extend(self.prefetched_fields())
+
+        return exclude
+
+    def _post_clean(self):
+        """Set prefetched foreign keys left out of model validation on the instance"""
+        super(ProvisionItemForm, self)._post_clean()
+
+        for name in self.prefetched_fields():
+            if name in self.cleaned_data:
+                setattr(self.instance, name, self.cleaned_data[name])
+
+    def prefetched_fields(self):
+        """Names of fields resolved from objects prefetched by the formset"""
+        return [name for name in ('item', 'user') if self.fields[name].prefetched is not None]
+
     def clean_quantity(self):
         quantity = self.cleaned_data['quantity']
 
@@ -243,17 +296,15 @@ class ProvisionItemForm(forms.ModelForm):
         self.instance.approved = True
         self.instance.approved_on = datetime.now()
 
-        # Decrementing item quantity
-        item = Item.objects.get(id=self.instance.item.id)
-        item.quantity -= self.instance.quantity
-        item.save()
+        # Decrementing item quantity, raises OutOfStock if it ran out meanwhile
+        Item.objects.take_stock(self.instance.item, self.instance.quantity)
 
         instance = super(ProvisionItemForm, self).save(commit=True)
 
         # Sending mail
         new_mail = item_provision_mail(self.instance.item.name, self.instance.user.email)
         recipients = [str(self.instance.user.email)]
-        cc_to = [str(user.email) for user in User.objects.filter(is_admin=True)]
+        cc_to = admin_cc(AdminEvent.PROVISIONED, [instance])
         send_mail_signal.send(sender=Provision, mail_data=new_mail, recipients=recipients, cc_to=cc_to)
 
         return instance
@@ -267,15 +318,78 @@ class ProvisionItemForm(forms.ModelForm):
             'quantity',
             'return_by'
         )
-        widgets = {
-            'user': autocomplete.ModelSelect2(url='user_autocomplete_ajax'),
-            'item': autocomplete.ModelSelect2(url='item_autocomplete_ajax'),
-        }
+
+
+def notify_users(kind, provisions_by_user, mail_factory):
+    """
+    Drop cached reports and dashboards after provisions changed in bulk,
+    bulk_create() and update() send no post_save, and send one mail to every
+    user with admins in cc. mail_factory builds the mail of a user given the
+    user and their provisions.
+    """
+    bump_generation('report')
+    bump_generation('dashboard:admin')
+
+    cc_to = admin_cc(kind, [
+        provision for user_provisions in provisions_by_user.values() for provision in user_provisions
+    ])
+
+    # Queued in the outbox with one insert, dispatched later in batches
+    with batched_mails():
+        for user, user_provisions in provisions_by_user.items():
+            bump_generation('dashboard:user:{0}'.format(user.id))
+
+            new_mail = mail_factory(user, user_provisions)
+            send_mail_signal.send(sender=Provision, mail_data=new_mail, recipients=[str(user.email)], cc_to=cc_to)
+
+
+def items_provisioned_mail(user, provisions):
+    """Generate one email for all items provisioned to a user"""
+    return item_provision_mail(', '.join(provision.item.name for provision in provisions), user.email)
 
 
 class ProvisionFormset(BaseFormSet):
     """Formset for provision items view"""
 
+    @cached_property
+    def prefetched_choices(self):
+        """
+        Items and users picked in any row, loaded with one query each and
+        shared by all forms. Inside a transaction the items are locked, so
+        quantities are checked against one snapshot that holds until saving
+        """
+        ids = {'item': set(), 'user': set()}
+
+        for i in range(self.total_form_count()):
+            for name in ids:
+                try:
+                    ids[name].add(int(self.data.get('{0}-{1}'.format(self.add_prefix(i), name))))
+
+                except (ValueError, TypeError):
+                    pass
+
+        fields = self.form.base_fields
+        items = fields['item'].queryset.filter(id__in=ids['item']).order_by('id')
+
+        if transaction.get_connection().in_atomic_block:
+            # Locking in id order, concurrent provisioning cannot deadlock
+            items = items.select_for_update()
+
+        return {
+            'item': {item.id: item for item in items},
+            'user': fields['user'].queryset.in_bulk(ids['user']),
+        }
+
+    def _construct_form(self, i, **kwargs):
+        """Hand prefetched items and users to every bound form"""
+        form = super(ProvisionFormset, self)._construct_form(i, **kwargs)
+
+        if self.is_bound:
+            for name, objects in self.prefetched_choices.items():
+                form.fields[name].prefetched = objects
+
+        return form
+
     def clean(self):
         """Creating clean function to check overall quantity of items in formset"""
 
@@ -302,6 +416,40 @@ class ProvisionFormset(BaseFormSet):
                     )
                 )
 
+    @transaction.atomic
+    def save(self):
+        """
+        Provision all rows at once, one insert for the provisions, one stock
+        update per item and one mail per user, raise OutOfStock if an item
+        ran out meanwhile
+        """
+        approved_on = datetime.now()
+        provisions = []
+        quantities = {}
+        counts = {}
+        provisions_by_user = {}
+
+        for form in self.forms:
+            provision = form.instance
+            provision.approved = True
+            provision.approved_on = approved_on
+            provisions.append(provision)
+
+            # Adding up quantity of every item and grouping rows by user
+            quantities[provision.item] = quantities.get(provision.item, 0) + provision.quantity
+            counts[provision.item] = counts.get(provision.item, 0) + 1
+            provisions_by_user.setdefault(provision.user, []).append(provision)
+
+        Item.objects.take_stocks(quantities)
+        Provision.objects.bulk_create(provisions)
+
+        for item, quantity in quantities.items():
+            DailyUsage.objects.add_provisions(item.id, approved_on.date(), quantity, count=counts[item])
+
+        notify_users(AdminEvent.PROVISIONED, provisions_by_user, items_provisioned_mail)
+
+        return provisions
+
 
 class ProvisionItemByRequestForm(forms.ModelForm):
     """Form to approve provision request"""
@@ -386,18 +534,16 @@ class ProvisionItemByRequestForm(forms.ModelForm):
         self.instance.return_by = datetime.now() + timedelta(days=7)
         self.instance.quantity = 1
 
-        # Decrementing item quantity
-        item = Item.objects.get(id=self.instance.item.id)
-        item_name = item.name
-        item.quantity -= self.instance.quantity
-        item.save()
+        # Decrementing item quantity, raises OutOfStock if it ran out meanwhile
+        Item.objects.take_stock(self.instance.item, self.instance.quantity)
+
         instance = super(ProvisionItemByRequestForm, self).save(commit=True)
 
         # Sending email
         user_email = self.instance.user.email
-        new_mail = item_provision_mail(item_name, user_email)
+        new_mail = item_provision_mail(self.instance.item.name, user_email)
         recipients = [str(self.instance.user.email)]
-        cc_to = [str(user.email) for user in User.objects.filter(is_admin=True)]
+        cc_to = admin_cc(AdminEvent.APPROVED, [instance])
         send_mail_signal.send(sender=Provision, mail_data=new_mail, recipients=recipients, cc_to=cc_to)
 
         return instance
@@ -415,6 +561,144 @@ class ProvisionItemByRequestForm(forms.ModelForm):
         }
 
 
+class BulkApproveForm(forms.Form):
+    """Form to approve many pending requests at once"""
+
+    # Requests approved meanwhile are skipped when saving, not rejected as invalid
+    provisions = forms.ModelMultipleChoiceField(
+        queryset=Provision.objects.all()
+    )
+
+    @transaction.atomic
+    def save(self):
+        """
+        Approve selected requests oldest first while their items have stock,
+        return the approved requests, the ones left pending for lack of stock
+        and the ones found approved already
+        """
+        ids = [provision.id for provision in self.cleaned_data['provisions']]
+        item_ids = Provision.objects.filter(id__in=ids).values_list('item_id', flat=True)
+
+        # Locking items before requests, in id order, like single approvals do
+        items = {
+            item.id: item
+            for item in Item.objects.select_for_update().filter(id__in=set(item_ids)).order_by('id')
+        }
+        pending = list(Provision.objects.select_for_update().filter(
+            id__in=ids,
+            approved=False
+        ).order_by('timestamp', 'id'))
+
+        # Approved by another admin since the dashboard was loaded
+        skipped = list(Provision.objects.filter(
+            id__in=set(ids) - set(provision.id for provision in pending)
+        ).select_related('item', 'user').order_by('timestamp', 'id'))
+
+        approved = []
+        failed = []
+        quantities = {}
+
+        for provision in pending:
+            provision.item = items[provision.item_id]
+            taken = quantities.get(provision.item, 0)
+
+            if provision.item.quantity - taken >= 1:
+                quantities[provision.item] = taken + 1
+                provision.quantity = 1
+                approved.append(provision)
+            else:
+                failed.append(provision)
+
+        users = User.objects.in_bulk(set(provision.user_id for provision in approved + failed))
+
+        for provision in approved + failed:
+            provision.user = users[provision.user_id]
+
+        if not approved:
+            return approved, failed, skipped
+
+        approved_on = datetime.now()
+
+        Item.objects.take_stocks(quantities)
+        # update() skips auto_now, moving timestamp like single approvals do keeps dashboards ordered
+        Provision.objects.filter(id__in=[provision.id for provision in approved]).update(
+            timestamp=approved_on,
+            approved=True,
+            approved_on=approved_on,
+            request_by_user=True,
+            return_by=approved_on + timedelta(days=7),
+            quantity=1
+        )
+
+        for item, quantity in quantities.items():
+            DailyUsage.objects.add_provisions(item.id, approved_on.date(), quantity, count=quantity)
+
+        provisions_by_user = {}
+
+        for provision in approved:
+            provisions_by_user.setdefault(provision.user, []).append(provision)
+
+        notify_users(AdminEvent.APPROVED, provisions_by_user, items_provisioned_mail)
+
+        return approved, failed, skipped
+
+
+class BulkReturnForm(forms.Form):
+    """Form to mark many provisions returned at once"""
+
+    provisions = forms.ModelMultipleChoiceField(
+        queryset=Provision.objects.filter(approved=True, returned=False)
+    )
+
+    @transaction.atomic
+    def save(self):
+        """Mark selected provisions returned and restock their items, return the provisions returned"""
+        ids = [provision.id for provision in self.cleaned_data['provisions']]
+        item_ids = Provision.objects.filter(id__in=ids).values_list('item_id', flat=True)
+
+        # Locking items before provisions, in id order, like single returns do
+        items = {
+            item.id: item
+            for item in Item.objects.select_for_update().filter(id__in=set(item_ids)).order_by('id')
+        }
+        returned = list(Provision.objects.select_for_update().filter(
+            id__in=ids,
+            approved=True,
+            returned=False
+        ).order_by('id'))
+
+        if not returned:
+            return returned
+
+        returned_on = datetime.now()
+        quantities = {}
+
+        for provision in returned:
+            provision.item = items[provision.item_id]
+            quantities[provision.item] = quantities.get(provision.item, 0) + (provision.quantity or 0)
+
+        Item.objects.restocks(quantities)
+        # update() skips auto_now, moving timestamp like single returns do
+        Provision.objects.filter(id__in=[provision.id for provision in returned]).update(
+            timestamp=returned_on,
+            returned=True,
+            returned_on=returned_on
+        )
+
+        for item, quantity in quantities.items():
+            DailyUsage.objects.add_returns(item.id, returned_on.date(), quantity)
+
+        users = User.objects.in_bulk(set(provision.user_id for provision in returned))
+        provisions_by_user = {}
+
+        for provision in returned:
+            provisions_by_user.setdefault(users[provision.user_id], []).append(provision)
+
+        notify_users(AdminEvent.RETURNED, provisions_by_user, lambda user, provisions: item_returned_mail(user.email))
+
+        return returned
+
+
 class RequestItemForm(forms.ModelForm):
     """Form to request an item"""
 
@@ -439,15 +723,14 @@ class ReturnItemForm(forms.ModelForm):
         """Marking as returned, incrementing item quantity, sending mail"""
         self.instance.returned = True
         self.instance.returned_on = datetime.now()
-        item = Item.objects.get(id=self.instance.item.id)
-        item.quantity += self.instance.quantity
-        item.save()
+        Item.objects.restock(self.instance.item, self.instance.quantity)
+
         instance = super(ReturnItemForm, self).save(commit=True)
 
         # Sending mail now
         new_mail = item_returned_mail(self.instance.user.email)
-        recipients = [str(User.objects.get(id=self.instance.user.id).email)]
-        cc_to = [str(user.email) for user in User.objects.filter(is_admin=True)]
+        recipients = [str(self.instance.user.email)]
+        cc_to = admin_cc(AdminEvent.RETURNED, [instance])
         send_mail_signal.send(sender=Provision, mail_data=new_mail, recipients=recipients, cc_to=cc_to)
 
         return instance
@@ -0,0 +1,145 @@
+"""SMTP connection kept open by each worker process for the mail tasks, and the outbox dispatcher"""
+from datetime import datetime, timedelta
+import smtplib
+import socket
+import time
+
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import worker_process_init, worker_process_shutdown
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F
+
+from inventory.models import OutboundMail
+
+
+# Connection of this process and when it last sent a message
+_connection = None
+_last_used = 0
+
+
+def get_pooled_connection():
+    """Open connection of this process, reopened when it was idle long enough for the server to drop it"""
+    global _connection
+
+    if _connection is not None and time.time() - _last_used > settings.EMAIL_CONNECTION_MAX_IDLE:
+        close_pooled_connection()
+
+    if _connection is None:
+        _connection = get_connection(fail_silently=False)
+        _connection.open()
+
+    return _connection
+
+
+def close_pooled_connection(**kwargs):
+    """Close the connection of this process"""
+    global _connection
+
+    if _connection is not None:
+        try:
+            _connection.close()
+
+        except (smtplib.SMTPException, socket.error):
+            pass
+
+        _connection = None
+
+
+@worker_process_init.connect
+def reset_pooled_connection(**kwargs):
+    """Forked worker processes open their own connection, the parent's socket is not theirs"""
+    global _connection
+    _connection = None
+
+
+worker_process_shutdown.connect(close_pooled_connection)
+
+
+def build_message(data):
+    """EmailMessage from the mail data passed to mail tasks"""
+    return EmailMessage(
+        subject=data['subject'],
+        body=data['body'],
+        to=data['to'],
+        cc=data['cc'],
+        bcc=data.get('bcc')
+    )
+
+
+def send_message(message):
+    """Send a message over the pooled connection, reconnecting once if the server dropped it"""
+    global _last_used
+
+    for attempt in range(2):
+        connection = get_pooled_connection()
+
+        try:
+            sent = connection.send_messages([message])
+
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            close_pooled_connection()
+
+            if attempt:
+                raise
+
+        else:
+            _last_used = time.time()
+            return sent
+
+
+def send_messages(messages):
+    """Send messages one by one over the pooled connection, return the number sent"""
+    return sum(send_message(message) or 0 for message in messages)
+
+
+def dispatch_outbox(max_batches=None):
+    """
+    Send due mails of the outbox in batches until none is left, failed mails
+    are retried later with a growing delay, return the number of mails sent
+    """
+    sent = 0
+    batches = 0
+    # Seconds between two mails, keeping under the rate the SMTP server allows
+    interval = 1.0 / settings.OUTBOX_RATE_LIMIT if settings.OUTBOX_RATE_LIMIT else 0
+
+    while max_batches is None or batches < max_batches:
+        outbound_mails = OutboundMail.objects.claim_batch(
+            settings.OUTBOX_BATCH_SIZE,
+            settings.OUTBOX_LEASE,
+            settings.OUTBOX_MAX_ATTEMPTS
+        )
+
+        if not outbound_mails:
+            break
+
+        batches += 1
+
+        for outbound_mail in outbound_mails:
+            started = time.time()
+
+            # Any failure only fails this mail, a bad row is counted as an attempt
+            # like a refused one, so it cannot abort the batch and resend the others
+            try:
+                send_message(build_message(outbound_mail.get_data()))
+
+            except SoftTimeLimitExceeded:
+                # Task ran out of time, mails sent so far are already marked
+                raise
+
+            except Exception as error:
+                delay = settings.OUTBOX_RETRY_DELAY * 2 ** outbound_mail.attempts
+                OutboundMail.objects.filter(id=outbound_mail.id).update(
+                    attempts=F('attempts') + 1,
+                    last_error=repr(error),
+                    next_attempt_on=datetime.now() + timedelta(seconds=delay)
+                )
+
+            else:
+                # Marked right away, a dispatcher stopped later never sends it again
+                OutboundMail.objects.filter(id=outbound_mail.id).update(sent_on=datetime.now(), claim='')
+                sent += 1
+
+            time.sleep(max(0, interval - (time.time() - started)))
+
+    return sent
@@ -0,0 +1,112 @@
+"""
+Measure mails per second against a local SMTP stand-in.
+
+Starts a stdlib smtpd server on a free local port and sends the same mails
+once with a new connection per mail, as the mail tasks used to, and once
+over the pooled connection the tasks use now:
+
+    python manage.py bench_mail --mails 500
+"""
+import asyncore
+import smtpd
+import threading
+import time
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from inventory import mail
+
+
+class CountingServer(smtpd.SMTPServer):
+    """SMTP server dropping messages after counting them"""
+
+    def __init__(self, *args, **kwargs):
+        smtpd.SMTPServer.__init__(self, *args, **kwargs)
+        self.received = 0
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+
+class Command(BaseCommand):
+    help = 'Measure mails per second against a local SMTP stand-in'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mails', type=int, default=200)
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=0.0,
+            help='Seconds added to every new connection, like a TLS handshake to a remote server'
+        )
+
+    def handle(self, *args, **options):
+        server = CountingServer(('127.0.0.1', 0), None)
+        host, port = server.socket.getsockname()
+
+        loop = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        loop.daemon = True
+        loop.start()
+
+        messages = [
+            EmailMessage(
+                subject='Inventory Item Provisioned',
+                body='Bench mail {0}'.format(i),
+                from_email='bench@example.com',
+                to=['user{0}@example.com'.format(i)],
+                cc=['admin@example.com']
+            )
+            for i in range(options['mails'])
+        ]
+
+        smtp_settings = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST=host,
+            EMAIL_PORT=port,
+            EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False
+        )
+
+        with smtp_settings:
+            latency = options['latency']
+
+            def per_message():
+                for message in messages:
+                    connection = get_connection()
+                    time.sleep(latency)
+                    connection.send_messages([message])
+
+            def pooled():
+                mail.close_pooled_connection()
+                time.sleep(latency)
+                mail.send_messages(messages)
+                mail.close_pooled_connection()
+
+            for name, send in (('connection per mail', per_message), ('pooled connection', pooled)):
+                server.received = server.connections = 0
+                start = time.time()
+                send()
+                elapsed = time.time() - start
+
+                # The server thread may still be reading the last message
+                deadline = time.time() + 5
+                while server.received < len(messages) and time.time() < deadline:
+                    time.sleep(0.01)
+
+                self.stdout.write('{0}: {1:.1f} mails/s, {2} mails over {3} connections'.format(
+                    name,
+                    len(messages) / elapsed,
+                    server.received,
+                    server.connections
+                ))
+
+        server.close()
@@ -0,0 +1,142 @@
+"""
+Show query plans and timings of the hot provision queries.
+
+Run it before and after migrating to 0004_provision_indexes to see the
+plans move from sequential scans to index scans, e.g.
+
+    python manage.py migrate inventory 0003
+    python manage.py bench_provision_queries --rows 200000
+    python manage.py migrate inventory 0004
+    python manage.py bench_provision_queries --rows 200000
+"""
+from datetime import datetime, timedelta
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from inventory.models import User, Item, Provision
+
+
+class Rollback(Exception):
+    """Raised to roll back the synthetic rows of a run"""
+
+
+class Command(BaseCommand):
+    help = 'Show query plans and timings of the hot provision queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=0,
+            help='Synthetic provisions inserted for the run, rolled back afterwards'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Runs of each query, the best time is shown'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['rows']:
+                    self.seed(options['rows'])
+
+                for name, queryset in self.hot_queries():
+                    self.benchmark(name, queryset, options['repeat'])
+
+                raise Rollback
+
+        except Rollback:
+            pass
+
+    def seed(self, rows):
+        """Insert synthetic provisions, mostly returned like a long lived inventory"""
+        User.objects.bulk_create(
+            User(email='bench{0}@example.com'.format(i), id_number='BENCH{0}'.format(i))
+            for i in range(100)
+        )
+        Item.objects.bulk_create(
+            Item(name='Bench item {0}'.format(i), returnable=True, quantity=1000)
+            for i in range(100)
+        )
+
+        # bulk_create does not return ids on every backend, reload them
+        users = list(User.objects.filter(email__startswith='bench').values_list('id', flat=True))
+        items = list(Item.objects.filter(name__startswith='Bench item').values_list('id', flat=True))
+        now = datetime.now()
+
+        def provision(i):
+            # 1 in 20 pending, 1 in 20 outstanding, the rest returned
+            state = i % 20
+            approved_on = now - timedelta(minutes=i)
+
+            return Provision(
+                item_id=items[i % len(items)],
+                user_id=users[i % len(users)],
+                approved=state != 0,
+                approved_on=approved_on if state != 0 else None,
+                quantity=1,
+                returned=state > 1,
+                returned_on=approved_on if state > 1 else None,
+            )
+
+        Provision.objects.bulk_create((provision(i) for i in range(rows)), batch_size=500)
+
+        if connection.vendor == 'postgresql':
+            connection.cursor().execute('ANALYZE inventory_provision')
+
+        self.stdout.write('Inserted {0} synthetic provisions'.format(rows))
+
+    def hot_queries(self):
+        """Queries issued by dashboard, load more, provision list and reports"""
+        user = User.objects.order_by('id').first()
+        provisions = Provision.objects.filter(returned=False)
+        now = datetime.now()
+
+        return (
+            ('admin pending', provisions.filter(
+                approved=False
+            ).order_by('timestamp', 'id')[:6]),
+            ('admin outstanding', provisions.filter(
+                approved=True
+            ).order_by('-timestamp', '-id')[:6]),
+            ('user pending', provisions.filter(
+                user=user,
+                approved=False
+            ).order_by('timestamp', 'id')[:6]),
+            ('user approved', provisions.filter(
+                user=user,
+                approved=True
+            ).order_by('-timestamp', '-id')[:6]),
+            ('provision list', provisions.filter(
+                approved=True
+            ).order_by('timestamp', 'id')[:50]),
+            ('approved on window', Provision.objects.filter(
+                approved_on__gte=now - timedelta(days=7),
+                approved_on__lt=now
+            )),
+        )
+
+    def benchmark(self, name, queryset, repeat):
+        """Print the plan and best time of a query"""
+        sql, params = queryset.query.sql_with_params()
+        explain = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+
+        cursor = connection.cursor()
+        cursor.execute(explain + sql, params)
+        plan = [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            # A fresh clone each run, evaluated querysets would hit their result cache
+            list(queryset.all())
+            timings.append(time.time() - start)
+
+        self.stdout.write('{0}: {1:.2f} ms'.format(name, min(timings) * 1000))
+        for line in plan:
+            self.stdout.write('    {0}'.format(line))
@@ -0,0 +1,109 @@
+"""
+Approve provisions of one hot item from many threads at once.
+
+Checks that no stock update is lost and measures approvals per second.
+The naive mode replays the old read, modify and save path to compare:
+
+    python manage.py bench_stock_contention --threads 16 --approvals 2000
+    python manage.py bench_stock_contention --threads 16 --approvals 2000 --mode naive
+"""
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from inventory.models import Item, OutOfStock
+
+
+class Command(BaseCommand):
+    help = 'Approve provisions of one hot item from many threads and check for lost updates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--approvals', type=int, default=1000,
+                            help='Approvals attempted in all')
+        parser.add_argument('--stock', type=int, default=None,
+                            help='Initial stock of the item, defaults to the number of approvals')
+        parser.add_argument('--mode', choices=('atomic', 'naive'), default='atomic')
+
+    def handle(self, *args, **options):
+        approvals = options['approvals']
+        stock = approvals if options['stock'] is None else options['stock']
+
+        item = Item.objects.create(
+            name='Contention bench {0}'.format(int(time.time() * 1000)),
+            returnable=False,
+            quantity=stock
+        )
+        approve = self.approve_atomic if options['mode'] == 'atomic' else self.approve_naive
+
+        lock = threading.Lock()
+        remaining = [approvals]
+        results = {'approved': 0, 'out_of_stock': 0, 'errors': 0}
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        if not remaining[0]:
+                            return
+                        remaining[0] -= 1
+
+                    try:
+                        approve(item)
+                        outcome = 'approved'
+
+                    except OutOfStock:
+                        outcome = 'out_of_stock'
+
+                    except Exception:
+                        outcome = 'errors'
+
+                    with lock:
+                        results[outcome] += 1
+
+            finally:
+                # Every thread has its own connection
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for i in range(options['threads'])]
+        start = time.time()
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.time() - start
+
+        final = Item.objects.get(id=item.id).quantity
+        item.delete()
+
+        lost = (stock - final) - results['approved']
+
+        self.stdout.write('Mode: {0}, threads: {1}'.format(options['mode'], options['threads']))
+        self.stdout.write('Approved: {approved}, out of stock: {out_of_stock}, errors: {errors}'.format(**results))
+        self.stdout.write('Stock: {0} -> {1}, lost updates: {2}'.format(stock, final, lost))
+        self.stdout.write('Approvals per second: {0:.1f}'.format(results['approved'] / elapsed))
+
+        if lost or final < 0:
+            raise CommandError('Stock does not match the approvals made')
+
+    @staticmethod
+    def approve_atomic(item):
+        """Single conditional UPDATE, as the provision forms do"""
+        with transaction.atomic():
+            Item.objects.take_stock(item, 1)
+
+    @staticmethod
+    def approve_naive(item):
+        """Read, modify in Python and save, as the provision forms used to"""
+        with transaction.atomic():
+            fresh = Item.objects.get(id=item.id)
+
+            if fresh.quantity < 1:
+                raise OutOfStock(item, 1)
+
+            fresh.quantity -= 1
+            fresh.save()
@@ -0,0 +1,177 @@
+"""
+Measure how long notification mails wait while large reports run.
+
+Workers are simulated by threads consuming in-memory queues, with tasks
+routed by the CELERY_ROUTES in use and each worker prefetching like a
+celery worker does. Task bodies are replaced by sleeps of the given length.
+The routed mode runs a worker per queue, as configured by
+CELERY_QUEUE_WORKERS, the shared mode one worker taking every task:
+
+    python manage.py bench_task_queues --reports 4 --report-seconds 5
+    python manage.py bench_task_queues --reports 4 --report-seconds 5 --mode shared
+"""
+import Queue
+import threading
+import time
+
+from celery import current_app
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+REPORT_TASK = 'run_report_job'
+MAIL_TASK = 'send_mail_task'
+
+
+class Command(BaseCommand):
+    help = 'Measure notification latency while large reports run, with and without queue routing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=('routed', 'shared'), default='routed')
+        parser.add_argument('--reports', type=int, default=4)
+        parser.add_argument('--report-seconds', type=float, default=5)
+        parser.add_argument('--notifications', type=int, default=100)
+        parser.add_argument('--mail-seconds', type=float, default=0.01)
+        parser.add_argument('--interval', type=float, default=0.05,
+                            help='Seconds between two notifications')
+
+    def handle(self, *args, **options):
+        workers = self.get_workers(options['mode'])
+
+        self.stdout.write('Mode: {0}, workers: {1}'.format(options['mode'], ', '.join(
+            '{0} (concurrency {1}, prefetch {2}{3})'.format(queue, concurrency, prefetch, ', fair' if fair else '')
+            for queue, (concurrency, prefetch, fair) in sorted(workers.items())
+        )))
+
+        for reports in (0, options['reports']):
+            latencies = self.run(workers, options['mode'], reports, options)
+            latencies.sort()
+
+            self.stdout.write(
+                'Reports running: {0}, notification wait p50: {1:.3f}s, p95: {2:.3f}s, max: {3:.3f}s'.format(
+                    reports,
+                    latencies[len(latencies) // 2],
+                    latencies[int(len(latencies) * 0.95)],
+                    latencies[-1]
+                )
+            )
+
+    @staticmethod
+    def get_workers(mode):
+        """Concurrency, prefetch multiplier and fair scheduling of the worker of each queue"""
+        if mode == 'routed':
+            # Bulk workers are started with -Ofair
+            return {
+                queue: (options['concurrency'], options['prefetch_multiplier'], queue == 'bulk')
+                for queue, options in settings.CELERY_QUEUE_WORKERS.items()
+            }
+
+        # A single worker as large as the routed ones together, with celery defaults
+        concurrency = sum(options['concurrency'] for options in settings.CELERY_QUEUE_WORKERS.values())
+        return {
+            settings.CELERY_DEFAULT_QUEUE: (concurrency, current_app.conf.CELERYD_PREFETCH_MULTIPLIER, False)
+        }
+
+    @staticmethod
+    def get_queue(mode, task_name):
+        """Queue the task is published to"""
+        if mode == 'routed':
+            return current_app.amqp.router.route({}, task_name)['queue'].name
+
+        return settings.CELERY_DEFAULT_QUEUE
+
+    def run(self, workers, mode, reports, options):
+        """Run the reports and notifications, return how long each notification waited"""
+        queues = {queue: Queue.Queue() for queue in workers}
+        stop = threading.Event()
+        lock = threading.Lock()
+        latencies = []
+        threads = []
+
+        def start(target, *args):
+            """Run target in a new thread"""
+            thread = threading.Thread(target=target, args=args)
+            thread.start()
+            threads.append(thread)
+
+        def process(inbox, busy, reserved):
+            """Pool process running the tasks handed to it, in order"""
+            while not stop.is_set():
+                try:
+                    task_name, published, duration = inbox.get(timeout=0.01)
+                except Queue.Empty:
+                    continue
+
+                busy.set()
+                if task_name == MAIL_TASK:
+                    with lock:
+                        latencies.append(time.time() - published)
+
+                time.sleep(duration)
+                busy.clear()
+
+                # Acknowledged, the consumer may prefetch another task
+                reserved.release()
+
+        def consumer(queue, concurrency, prefetch, fair):
+            """
+            Prefetch up to concurrency * prefetch tasks and hand them to the pool,
+            round robin, or to idle processes only when fair
+            """
+            reserved = threading.Semaphore(concurrency * prefetch)
+            pool = [(Queue.Queue(), threading.Event()) for i in range(concurrency)]
+
+            for inbox, busy in pool:
+                start(process, inbox, busy, reserved)
+
+            turn = 0
+            while not stop.is_set():
+                if not reserved.acquire(False):
+                    time.sleep(0.001)
+                    continue
+
+                try:
+                    task = queues[queue].get(timeout=0.01)
+                except Queue.Empty:
+                    reserved.release()
+                    continue
+
+                while True:
+                    inbox, busy = pool[turn % concurrency]
+                    turn += 1
+
+                    if not fair or (inbox.empty() and not busy.is_set()):
+                        inbox.put(task)
+                        break
+
+                    if not turn % concurrency:
+                        time.sleep(0.001)
+
+        for queue, (concurrency, prefetch, fair) in workers.items():
+            start(consumer, queue, concurrency, prefetch, fair)
+
+        def publish(task_name, duration):
+            """Put a task on the queue it is routed to"""
+            queues[self.get_queue(mode, task_name)].put((task_name, time.time(), duration))
+
+        try:
+            for i in range(reports):
+                publish(REPORT_TASK, options['report_seconds'])
+
+            for i in range(options['notifications']):
+                publish(MAIL_TASK, options['mail_seconds'])
+                time.sleep(options['interval'])
+
+            while True:
+                with lock:
+                    if len(latencies) == options['notifications']:
+                        break
+                time.sleep(0.01)
+
+        finally:
+            # Reports still running are waited for by the threads
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        return latencies
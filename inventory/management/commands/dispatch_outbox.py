@@ -0,0 +1,34 @@
+"""Send mails queued in the outbox, for deployments without celery beat"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from inventory.mail import close_pooled_connection, dispatch_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send mails queued in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop',
+            type=float,
+            default=0,
+            help='Keep dispatching, waiting this many seconds once the outbox is drained'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                sent = dispatch_outbox()
+
+                if sent or not options['loop']:
+                    self.stdout.write('Sent {0} mails'.format(sent))
+
+                if not options['loop']:
+                    break
+
+                time.sleep(options['loop'])
+
+        finally:
+            close_pooled_connection()
@@ -0,0 +1,60 @@
+"""Rebuild the daily usage rollup from provision history"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from inventory.caching import bump_generation, bump_pending_generations
+from inventory.models import Provision, DailyUsage, daily_usage_totals
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily usage rollup used by reports from provision history'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of rollup rows inserted per query'
+        )
+
+    def handle(self, *args, **options):
+        count = self.rebuild(options['batch_size'])
+
+        # Reports cached while the rollup was rebuilt are dropped once it committed
+        bump_pending_generations()
+
+        self.stdout.write('Rebuilt {0} daily usage rows'.format(count))
+
+    @transaction.atomic
+    def rebuild(self, batch_size):
+        """Replace the rollup rows with totals summed from provision history, return their number"""
+        provisions = Provision.objects.filter(
+            approved_on__isnull=False
+        ).values_list(
+            'item_id',
+            'approved_on',
+            'quantity',
+            'returned',
+            'returned_on'
+        ).iterator()
+
+        # (item, day) -> [provisioned, provisions, returned]
+        totals = daily_usage_totals(provisions)
+
+        DailyUsage.objects.all().delete()
+        DailyUsage.objects.bulk_create(
+            (
+                DailyUsage(
+                    item_id=item_id,
+                    day=day,
+                    provisioned=provisioned,
+                    provisions=count,
+                    returned=returned
+                )
+                for (item_id, day), (provisioned, count, returned) in totals.items()
+            ),
+            batch_size=batch_size
+        )
+        bump_generation('report')
+
+        return len(totals)
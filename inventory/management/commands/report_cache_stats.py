@@ -0,0 +1,23 @@
+"""Show how well the report cache works"""
+from django.core.management.base import BaseCommand
+
+from inventory.caching import check_shared_cache
+from inventory.reports import get_report_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Show hits and misses of the report cache'
+
+    def handle(self, *args, **options):
+        # Counters of a cache kept in this process never saw a report served elsewhere
+        for warning in check_shared_cache(None):
+            self.stderr.write('{0}, stats only cover this process'.format(warning.msg))
+
+        stats = get_report_cache_stats()
+        lookups = stats['hits'] + stats['misses']
+
+        self.stdout.write('Hits: {0}'.format(stats['hits']))
+        self.stdout.write('Misses: {0}'.format(stats['misses']))
+        self.stdout.write('Hit ratio: {0:.1%}'.format(
+            float(stats['hits']) / lookups if lookups else 0
+        ))
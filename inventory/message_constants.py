@@ -9,6 +9,9 @@ REQUEST_SUBMITTED_MESSAGE = 'Your request has been submitted'
 ITEM_RETURNED_MESSAGE = 'The item has been marked returned'
 PASSWORD_CHANGE_SUCCESS_MESSAGE = 'Password has been changed successfully'
 PROFILE_UPDATE_SUCCESS_MESSAGE = 'Profile has been updated successfully'
+REPORT_QUEUED_MESSAGE = 'Report is being generated, it will be mailed to you'
+NO_REQUESTS_SELECTED_MESSAGE = 'Please select pending requests to approve'
+NO_PROVISIONS_SELECTED_MESSAGE = 'Please select provisions to mark returned'
 
 
 def item_added_message(item_name):
@@ -51,11 +54,40 @@ def item_returned_mail(user_email):
     return new_mail
 
 
+def out_of_stock_message(item_name):
+    """Generate error message when an item ran out of stock while provisioning"""
+    return 'Not enough {0} left in inventory, please check the quantity'.format(item_name)
+
+
+def bulk_return_message(count):
+    """Generate confirmation message for provisions marked returned at once"""
+    return '{0} provision(s) marked returned'.format(count)
+
+
 def item_provision_message(item_name, user_email):
     """Generate confirmation message for an item provisioned"""
     return '{0} is provisioned to {1}'.format(item_name, user_email)
 
 
+def bulk_approve_message(count):
+    """Generate confirmation message for pending requests approved at once"""
+    return '{0} request(s) approved'.format(count)
+
+
+def bulk_approve_failed_message(requests):
+    """Generate error message for requests left pending for lack of stock"""
+    return 'Not enough stock to approve these requests: {0}'.format(
+        ', '.join('{0} for {1}'.format(item_name, user_email) for item_name, user_email in requests)
+    )
+
+
+def bulk_approve_skipped_message(requests):
+    """Generate warning message for selected requests found approved already"""
+    return 'These requests were approved already: {0}'.format(
+        ', '.join('{0} for {1}'.format(item_name, user_email) for item_name, user_email in requests)
+    )
+
+
 def item_provision_mail(item_name, user_email):
     """Generate email when an item is provisioned"""
     new_mail = {
@@ -64,3 +96,47 @@ def item_provision_mail(item_name, user_email):
     }
 
     return new_mail
+
+
+def admin_digest_mail(summary):
+    """Generate digest email for admins, given (kind, item name, count, quantity) rows"""
+    lines = [
+        '{0} - {1}: {2} time(s), quantity {3}'.format(kind, item_name, count, quantity)
+        for kind, item_name, count, quantity in summary
+    ]
+    new_mail = {
+        'subject': 'Inventory Digest',
+        'body': 'Inventory activity since the last digest:\n\n{0}'.format('\n'.join(lines))
+    }
+
+    return new_mail
+
+
+def report_mail():
+    """Generate email carrying a report"""
+    new_mail = {
+        'subject': 'Report',
+        'body': 'Report attached'
+    }
+
+    return new_mail
+
+
+def report_link_mail(url):
+    """Generate email linking to a report too large to attach"""
+    new_mail = {
+        'subject': 'Report',
+        'body': 'Report is too large to attach, download it from {0}'.format(url)
+    }
+
+    return new_mail
+
+
+def empty_report_mail():
+    """Generate email for a report with no data"""
+    new_mail = {
+        'subject': 'Report',
+        'body': 'No data matched the filters of the requested report'
+    }
+
+    return new_mail
@@ -0,0 +1,123 @@
+"""Metrics of celery tasks, recorded by task signals and kept in the shared cache"""
+import json
+import time
+
+from celery import current_app
+from celery.signals import before_task_publish, task_failure, task_postrun, task_prerun
+from django.core.cache import cache
+
+from inventory.caching import get_counters, increment_counter
+
+
+# Histograms recorded per task, with their bucket bounds and the factor
+# turning observed values into the integers counters hold
+HISTOGRAMS = (
+    ('wait_seconds', (0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120, 600), 1000),
+    ('run_seconds', (0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120, 600), 1000),
+    ('payload_bytes', (256, 1024, 4096, 16384, 65536, 262144, 1048576), 1),
+)
+
+# Start of tasks running in this process, by task id
+_started = {}
+
+
+def published_key(task_id):
+    """Cache key holding when a task was published"""
+    return 'task-published:{0}'.format(task_id)
+
+
+def metric_name(task_name, metric, part):
+    """Name of the counter holding part of a metric of a task"""
+    return 'task:{0}:{1}:{2}'.format(task_name, metric, part)
+
+
+def observe(task_name, metric, value):
+    """Record a value in a histogram of a task"""
+    for name, buckets, scale in HISTOGRAMS:
+        if name == metric:
+            bucket = next((bound for bound in buckets if value <= bound), '+Inf')
+
+            increment_counter(metric_name(task_name, metric, 'bucket:{0}'.format(bucket)))
+            increment_counter(metric_name(task_name, metric, 'sum'), int(round(value * scale)))
+            increment_counter(metric_name(task_name, metric, 'count'))
+
+
+@before_task_publish.connect
+def record_published(sender=None, body=None, **kwargs):
+    """Remember when a task was queued and record the size of its arguments"""
+    if not body or 'id' not in body:
+        return
+
+    cache.set(published_key(body['id']), time.time(), 60 * 60 * 24)
+    observe(sender, 'payload_bytes', len(json.dumps([body.get('args'), body.get('kwargs')])))
+
+
+@task_prerun.connect
+def record_started(task_id=None, task=None, **kwargs):
+    """Record how long a task waited in the queue"""
+    _started[task_id] = time.time()
+
+    # Clocks of the publishing and the running host are assumed to agree
+    published = cache.get(published_key(task_id))
+    if published is not None:
+        cache.delete(published_key(task_id))
+        observe(task.name, 'wait_seconds', max(0, _started[task_id] - published))
+
+
+@task_postrun.connect
+def record_finished(task_id=None, task=None, **kwargs):
+    """Record how long a task ran"""
+    started = _started.pop(task_id, None)
+
+    if started is not None:
+        observe(task.name, 'run_seconds', time.time() - started)
+
+
+@task_failure.connect
+def record_failure(sender=None, **kwargs):
+    """Count failed runs of a task"""
+    increment_counter(metric_name(sender.name, 'failures', 'count'))
+
+
+def task_names():
+    """Names of the tasks of this project"""
+    return sorted(name for name in current_app.tasks if not name.startswith('celery.'))
+
+
+def render_metrics():
+    """Metrics of all tasks in the Prometheus text format"""
+    names = task_names()
+    parts = ['failures:count']
+
+    for metric, buckets, scale in HISTOGRAMS:
+        parts.extend('{0}:bucket:{1}'.format(metric, bound) for bound in buckets + ('+Inf',))
+        parts.extend(('{0}:sum'.format(metric), '{0}:count'.format(metric)))
+
+    counters = get_counters([
+        'task:{0}:{1}'.format(name, part) for name in names for part in parts
+    ])
+
+    def value(name, metric, part):
+        return counters[metric_name(name, metric, part)]
+
+    lines = []
+
+    for metric, buckets, scale in HISTOGRAMS:
+        full_name = 'inventory_task_{0}'.format(metric)
+        lines.append('# TYPE {0} histogram'.format(full_name))
+
+        for name in names:
+            cumulative = 0
+
+            for bound in buckets + ('+Inf',):
+                cumulative += value(name, metric, 'bucket:{0}'.format(bound))
+                lines.append('{0}_bucket{{task="{1}",le="{2}"}} {3}'.format(full_name, name, bound, cumulative))
+
+            lines.append('{0}_sum{{task="{1}"}} {2}'.format(full_name, name, value(name, metric, 'sum') / float(scale)))
+            lines.append('{0}_count{{task="{1}"}} {2}'.format(full_name, name, value(name, metric, 'count')))
+
+    lines.append('# TYPE inventory_task_failures_total counter')
+    for name in names:
+        lines.append('inventory_task_failures_total{{task="{0}"}} {1}'.format(name, value(name, 'failures', 'count')))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,17 @@
+"""Inventory App Middleware"""
+from inventory.caching import bump_pending_generations
+
+
+class PendingGenerationsMiddleware(object):
+    """
+    Bump again the cache generations bumped inside the transactions of a
+    request, they are committed by the time the response is returned
+    """
+
+    def process_request(self, request):
+        # Left by work done outside of requests in this thread, ended by now
+        bump_pending_generations()
+
+    def process_response(self, request, response):
+        bump_pending_generations()
+        return response
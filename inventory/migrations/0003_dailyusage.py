@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from inventory.models import daily_usage_totals
+
+
+def backfill_daily_usage(apps, schema_editor):
+    """Fill the rollup from provision history, reports read only from it"""
+    Provision = apps.get_model('inventory', 'Provision')
+    DailyUsage = apps.get_model('inventory', 'DailyUsage')
+
+    provisions = Provision.objects.filter(
+        approved_on__isnull=False
+    ).values_list(
+        'item_id',
+        'approved_on',
+        'quantity',
+        'returned',
+        'returned_on'
+    ).iterator()
+
+    DailyUsage.objects.bulk_create(
+        (
+            DailyUsage(
+                item_id=item_id,
+                day=day,
+                provisioned=provisioned,
+                provisions=count,
+                returned=returned
+            )
+            for (item_id, day), (provisioned, count, returned) in daily_usage_totals(provisions).items()
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0002_auto_20160217_1544'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyUsage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('provisioned', models.IntegerField(default=0)),
+                ('provisions', models.IntegerField(default=0)),
+                ('returned', models.IntegerField(default=0)),
+                ('item', models.ForeignKey(to='inventory.Item')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyusage',
+            unique_together=set([('item', 'day')]),
+        ),
+        migrations.RunPython(backfill_daily_usage, migrations.RunPython.noop),
+    ]
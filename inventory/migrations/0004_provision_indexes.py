@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+PARTIAL_INDEXES = (
+    # Pending requests, newest last on the dashboard
+    ('inventory_provision_pending', 'approved = false AND returned = false'),
+    # Approved provisions not returned yet
+    ('inventory_provision_outstanding', 'approved = true AND returned = false'),
+)
+
+
+def create_partial_indexes(apps, schema_editor):
+    """Partial indexes are only supported on PostgreSQL"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for name, condition in PARTIAL_INDEXES:
+        schema_editor.execute(
+            'CREATE INDEX {0} ON inventory_provision (timestamp, id) WHERE {1}'.format(name, condition)
+        )
+
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for name, condition in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {0}'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0003_dailyusage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='provision',
+            name='approved_on',
+            field=models.DateTimeField(null=True, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='provision',
+            index_together=set([('approved', 'returned', 'timestamp', 'id'), ('user', 'approved', 'returned', 'timestamp', 'id')]),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import datetime
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0004_provision_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundMail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('data', models.TextField()),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt_on', models.DateTimeField(default=datetime.datetime.now)),
+                ('sent_on', models.DateTimeField(null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('claim', models.CharField(max_length=32, blank=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='outboundmail',
+            index_together=set([('sent_on', 'next_attempt_on', 'id')]),
+        ),
+    ]
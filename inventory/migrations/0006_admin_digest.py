@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0005_outboundmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdminEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=20, choices=[(b'provisioned', b'Provisioned'), (b'approved', b'Requests approved'), (b'returned', b'Returned')])),
+                ('quantity', models.IntegerField(default=0)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('item', models.ForeignKey(to='inventory.Item')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='admin_digest',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0006_admin_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('params', models.TextField()),
+                ('params_hash', models.CharField(max_length=32, db_index=True)),
+                ('generation', models.BigIntegerField(default=0)),
+                ('status', models.CharField(default=b'queued', max_length=10, choices=[(b'queued', b'Queued'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')])),
+                ('chunks', models.IntegerField(default=0)),
+                ('chunks_done', models.IntegerField(default=0)),
+                ('rows', models.IntegerField(null=True)),
+                ('artifact', models.CharField(max_length=255, blank=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('finished_on', models.DateTimeField(null=True)),
+                ('requested_by', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+    ]
@@ -1,10 +1,16 @@
 """Inventory App Models"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+import hashlib
+import json
 import os
 import time
+import uuid
 
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
+from django.core.cache import cache
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import IntegrityError, OperationalError, models, transaction
 
 
 # REGEX used
@@ -127,6 +133,11 @@ class User(AbstractBaseUser):
         default=False
     )
 
+    # Admins taking a periodic digest instead of a cc on every notification
+    admin_digest = models.BooleanField(
+        default=False
+    )
+
     USERNAME_FIELD = 'email'
     objects = UserManager()
 
@@ -164,6 +175,71 @@ class User(AbstractBaseUser):
             pass
 
 
+class OutOfStock(Exception):
+    """Raised when an item does not have the quantity asked for"""
+
+    def __init__(self, item, quantity):
+        super(OutOfStock, self).__init__(
+            'Only less than {0} of {1} are available'.format(quantity, item)
+        )
+        self.item = item
+        self.quantity = quantity
+
+
+class ItemManager(models.Manager):
+    """Manager changing item stock with single conditional updates"""
+
+    # Attempts of a stock update failing on lock contention, and the first back off in seconds
+    stock_update_attempts = 3
+    stock_update_delay = 0.05
+
+    def _retry_on_contention(self, operation):
+        """Run a stock update, retrying when the database is contended"""
+        for attempt in range(self.stock_update_attempts):
+            try:
+                # A savepoint keeps the outer transaction usable after a failed attempt
+                with transaction.atomic():
+                    return operation()
+
+            except OperationalError:
+                if attempt == self.stock_update_attempts - 1:
+                    raise
+
+                time.sleep(self.stock_update_delay * 2 ** attempt)
+
+    def take_stock(self, item, quantity):
+        """Decrement stock of an item unless it has less than quantity, raise OutOfStock then"""
+        self.take_stocks({item: quantity})
+
+    def take_stocks(self, quantities):
+        """
+        Decrement stock of several items at once, one update per item,
+        nothing is taken if any item has less than its quantity
+        """
+        def update():
+            # Same lock order in every transaction, so concurrent ones cannot deadlock
+            for item in sorted(quantities, key=lambda item: item.id):
+                quantity = quantities[item]
+                items = self.filter(id=item.id, quantity__gte=quantity)
+
+                if not items.update(quantity=models.F('quantity') - quantity):
+                    raise OutOfStock(item, quantity)
+
+        self._retry_on_contention(update)
+
+    def restock(self, item, quantity):
+        """Increment stock of an item"""
+        self.restocks({item: quantity})
+
+    def restocks(self, quantities):
+        """Increment stock of several items at once, one update per item"""
+        def update():
+            for item in sorted(quantities, key=lambda item: item.id):
+                self.filter(id=item.id).update(quantity=models.F('quantity') + quantities[item])
+
+        self._retry_on_contention(update)
+
+
 class Item(models.Model):
     """Model for inventory items"""
 
@@ -183,6 +259,8 @@ class Item(models.Model):
         default=1,
     )
 
+    objects = ItemManager()
+
     def __unicode__(self):
         """unicode method"""
         return self.name
@@ -204,6 +282,7 @@ class Provision(models.Model):
 
     approved_on = models.DateTimeField(
         null=True,
+        db_index=True,
     )
 
     return_by = models.DateTimeField(
@@ -225,3 +304,385 @@ class Provision(models.Model):
     request_by_user = models.BooleanField(
         default=False
     )
+
+    class Meta:
+        """Meta Class"""
+        # Matching the filters and ordering of dashboard and provision lists,
+        # PostgreSQL also gets partial indexes for the pending and outstanding sets
+        index_together = (
+            ('approved', 'returned', 'timestamp', 'id'),
+            ('user', 'approved', 'returned', 'timestamp', 'id'),
+        )
+
+
+# Provision fields the daily usage rollup is summed from
+DAILY_USAGE_FIELDS = ('item_id', 'approved_on', 'quantity', 'returned', 'returned_on')
+
+
+def daily_usage_totals(provisions):
+    """
+    Sum provision history into daily usage rows, given (item_id, approved_on,
+    quantity, returned, returned_on) of approved provisions. Returns
+    (item_id, day) -> [provisioned, provisions, returned].
+    """
+    totals = defaultdict(lambda: [0, 0, 0])
+
+    for item_id, approved_on, quantity, returned, returned_on in provisions:
+        quantity = quantity or 0
+
+        row = totals[(item_id, approved_on.date())]
+        row[0] += quantity
+        row[1] += 1
+
+        if returned and returned_on:
+            totals[(item_id, returned_on.date())][2] += quantity
+
+    return totals
+
+
+class DailyUsageManager(models.Manager):
+    """Manager keeping the daily usage rollup up to date"""
+
+    def _increment(self, item_id, day, create=True, **deltas):
+        """Add deltas to the rollup row of an item for a day, create it if missing and asked to"""
+        rows = self.filter(item_id=item_id, day=day)
+        changes = {field: models.F(field) + delta for field, delta in deltas.items()}
+
+        if not rows.update(**changes) and create:
+            try:
+                with transaction.atomic():
+                    self.create(item_id=item_id, day=day, **deltas)
+
+            except IntegrityError:
+                # Row was created concurrently, add to it instead
+                rows.update(**changes)
+
+    def add_provisions(self, item_id, day, quantity, count=1):
+        """Record provisions of an item approved on a day"""
+        self._increment(item_id, day, provisioned=quantity, provisions=count)
+
+    def add_returns(self, item_id, day, quantity):
+        """Record returns of an item on a day"""
+        self._increment(item_id, day, returned=quantity)
+
+    def change_provision(self, before, after):
+        """
+        Move a provision's share of the rollup from its values before a
+        change to its values after it, both given as DAILY_USAGE_FIELDS
+        values, None before it is created or after it is deleted
+        """
+        old = daily_usage_totals([before] if before and before[1] else [])
+        new = daily_usage_totals([after] if after and after[1] else [])
+
+        for item_id, day in set(old) | set(new):
+            before_totals = old.get((item_id, day), [0, 0, 0])
+            after_totals = new.get((item_id, day), [0, 0, 0])
+            deltas = dict(zip(
+                ('provisioned', 'provisions', 'returned'),
+                [after_total - before_total for before_total, after_total in zip(before_totals, after_totals)]
+            ))
+
+            if any(deltas.values()):
+                # Rows are only taken from when they exist, they may be deleted along with their item
+                self._increment(item_id, day, create=max(deltas.values()) > 0, **deltas)
+
+
+class DailyUsage(models.Model):
+    """Rollup of provisions and returns per item per day, used by reports"""
+
+    item = models.ForeignKey(Item)
+
+    day = models.DateField()
+
+    provisioned = models.IntegerField(
+        default=0,
+    )
+
+    provisions = models.IntegerField(
+        default=0,
+    )
+
+    returned = models.IntegerField(
+        default=0,
+    )
+
+    objects = DailyUsageManager()
+
+    class Meta:
+        """Meta Class"""
+        unique_together = (
+            ('item', 'day'),
+        )
+
+
+class OutboundMailManager(models.Manager):
+    """Manager queueing mails and handing them out to dispatchers in batches"""
+
+    def queue(self, data):
+        """Queue a mail, given the data mail tasks take"""
+        return self.create(data=json.dumps(data))
+
+    def queue_many(self, mails):
+        """Queue mails with a single insert"""
+        self.bulk_create(OutboundMail(data=json.dumps(data)) for data in mails)
+
+    def due(self, max_attempts):
+        """Mails not sent yet, not claimed by a dispatcher and not waiting to be retried"""
+        return self.filter(
+            sent_on__isnull=True,
+            attempts__lt=max_attempts,
+            next_attempt_on__lte=datetime.now()
+        )
+
+    def claim_batch(self, size, lease, max_attempts):
+        """
+        Claim up to size due mails for lease seconds, mails of a dispatcher
+        stopping before it sends them are due again once the lease ends
+        """
+        due = self.due(max_attempts)
+        ids = list(due.order_by('next_attempt_on', 'id').values_list('id', flat=True)[:size])
+
+        if not ids:
+            return []
+
+        # Updating only rows still due, a concurrent dispatcher cannot claim them twice
+        claim = uuid.uuid4().hex
+        due.filter(id__in=ids).update(
+            claim=claim,
+            next_attempt_on=datetime.now() + timedelta(seconds=lease)
+        )
+
+        return list(self.filter(id__in=ids, claim=claim).order_by('id'))
+
+
+class OutboundMail(models.Model):
+    """Mail queued in the transaction that caused it, sent later by a dispatcher"""
+
+    # Mail data as taken by mail tasks, as JSON
+    data = models.TextField()
+
+    created_on = models.DateTimeField(
+        auto_now_add=True,
+    )
+
+    next_attempt_on = models.DateTimeField(
+        default=datetime.now,
+    )
+
+    sent_on = models.DateTimeField(
+        null=True,
+    )
+
+    attempts = models.IntegerField(
+        default=0,
+    )
+
+    claim = models.CharField(
+        max_length=32,
+        blank=True,
+    )
+
+    last_error = models.TextField(
+        blank=True,
+    )
+
+    objects = OutboundMailManager()
+
+    class Meta:
+        """Meta Class"""
+        index_together = (
+            ('sent_on', 'next_attempt_on', 'id'),
+        )
+
+    def get_data(self):
+        """Mail data as taken by mail tasks"""
+        return json.loads(self.data)
+
+
+class AdminEvent(models.Model):
+    """Notification held back for admins taking a digest, flushed periodically"""
+
+    PROVISIONED = 'provisioned'
+    APPROVED = 'approved'
+    RETURNED = 'returned'
+    KINDS = (
+        (PROVISIONED, 'Provisioned'),
+        (APPROVED, 'Requests approved'),
+        (RETURNED, 'Returned'),
+    )
+
+    kind = models.CharField(
+        max_length=20,
+        choices=KINDS,
+    )
+
+    item = models.ForeignKey(Item)
+
+    quantity = models.IntegerField(
+        default=0,
+    )
+
+    created_on = models.DateTimeField(
+        auto_now_add=True,
+    )
+
+
+class ReportJobManager(models.Manager):
+    """Manager starting report jobs, folding identical requests onto one job"""
+
+    # Seconds a request creating a job holds the lock of its filters, and
+    # how often identical requests check whether the lock was released
+    creation_lock_timeout = 10
+    creation_poll_interval = 0.05
+
+    def get_or_create_for(self, filters, user, generation, timeout):
+        """
+        Return a job for filters and whether it was created. An identical
+        job still running, or finished on the same report generation, is
+        returned instead of a new one. Jobs running for longer than timeout
+        seconds are taken as lost. Identical requests arriving together are
+        serialized by a lock in the shared cache, only one creates the job.
+        """
+        params = json.dumps(filters, sort_keys=True)
+        params_hash = hashlib.md5(params).hexdigest()
+        lock = 'report-job-lock:{0}'.format(params_hash)
+        deadline = time.time() + self.creation_lock_timeout
+
+        while True:
+            job = self.find_identical(params_hash, generation, timeout)
+
+            if job:
+                return job, False
+
+            if cache.add(lock, True, self.creation_lock_timeout):
+                break
+
+            if time.time() >= deadline:
+                # The request holding the lock was lost, its lock expires by itself
+                lock = None
+                break
+
+            self.wait_for_lock()
+
+        try:
+            # The request holding the lock before may have created the job meanwhile
+            job = self.find_identical(params_hash, generation, timeout)
+
+            if job:
+                return job, False
+
+            return self.create(
+                params=params,
+                params_hash=params_hash,
+                generation=generation,
+                requested_by=user
+            ), True
+
+        finally:
+            if lock:
+                cache.delete(lock)
+
+    def find_identical(self, params_hash, generation, timeout):
+        """Identical job still running, or finished on the same report generation"""
+        jobs = self.filter(params_hash=params_hash).order_by('-created_on', '-id')
+
+        return (
+            jobs.filter(
+                status__in=(ReportJob.QUEUED, ReportJob.RUNNING),
+                created_on__gte=datetime.now() - timedelta(seconds=timeout)
+            ).first() or
+            jobs.filter(status=ReportJob.DONE, generation=generation).first()
+        )
+
+    def wait_for_lock(self):
+        """Wait before checking again for a job an identical request is creating"""
+        time.sleep(self.creation_poll_interval)
+
+
+class ReportJob(models.Model):
+    """Report generated by the workers, kept as a file to download again"""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    # Report filters, as JSON
+    params = models.TextField()
+
+    params_hash = models.CharField(
+        max_length=32,
+        db_index=True,
+    )
+
+    # Report generation the job was requested on, done jobs of the current one are reused
+    generation = models.BigIntegerField(
+        default=0,
+    )
+
+    requested_by = models.ForeignKey(
+        User,
+        null=True,
+        on_delete=models.SET_NULL,
+    )
+
+    status = models.CharField(
+        max_length=10,
+        choices=STATUSES,
+        default=QUEUED,
+    )
+
+    chunks = models.IntegerField(
+        default=0,
+    )
+
+    chunks_done = models.IntegerField(
+        default=0,
+    )
+
+    rows = models.IntegerField(
+        null=True,
+    )
+
+    # Name of the report file in report storage
+    artifact = models.CharField(
+        max_length=255,
+        blank=True,
+    )
+
+    created_on = models.DateTimeField(
+        auto_now_add=True,
+    )
+
+    finished_on = models.DateTimeField(
+        null=True,
+    )
+
+    objects = ReportJobManager()
+
+    def get_filters(self):
+        """Report filters of the job"""
+        return json.loads(self.params)
+
+    def get_progress(self):
+        """Status of the job, as polled by the report page"""
+        if self.status == self.DONE:
+            percent = 100
+        else:
+            # Merging is the last step, the report is only complete once merged
+            percent = min(99, 100 * self.chunks_done // max(self.chunks, 1))
+
+        return {
+            'id': self.id,
+            'status': self.status,
+            'chunks': self.chunks,
+            'chunks_done': self.chunks_done,
+            'percent': percent,
+            'rows': self.rows,
+        }
@@ -0,0 +1,48 @@
+"""Keyset pagination for provision lists"""
+from datetime import datetime
+
+from django.db.models import Q
+
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(provision):
+    """Cursor pointing right after a provision in (timestamp, id) order"""
+    return '{0}_{1}'.format(
+        provision.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT),
+        provision.id
+    )
+
+
+def decode_cursor(cursor):
+    """Split a cursor into its timestamp and id, raise ValueError if malformed"""
+    timestamp, pk = cursor.rsplit('_', 1)
+    return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(pk)
+
+
+def keyset_page(queryset, cursor, size, descending=False):
+    """
+    Fetch the page of provisions following cursor in (timestamp, id) order,
+    return the rows and the cursor of the next page, None on the last page
+    """
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+
+        if descending:
+            queryset = queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+            )
+
+        else:
+            queryset = queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+            )
+
+    ordering = ('-timestamp', '-id') if descending else ('timestamp', 'id')
+
+    # One extra row tells if another page follows
+    rows = list(queryset.order_by(*ordering)[:size + 1])
+    next_cursor = encode_cursor(rows[size - 1]) if len(rows) > size else None
+
+    return rows[:size], next_cursor
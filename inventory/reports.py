@@ -0,0 +1,292 @@
+"""Inventory App Reports"""
+import csv
+from datetime import date, datetime, timedelta
+import gzip
+import hashlib
+import heapq
+import json
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db.models import Max, Min, Q, Sum
+
+from inventory.caching import get_generation, get_counter, increment_counter
+from inventory.models import DailyUsage, Item
+
+
+# Columns of the report, in the order they are exported
+REPORT_FIELDS = ('name', 'description', 'returnable', 'quantity')
+
+# Columns of the report table which can be ordered in SQL
+REPORT_ORDERING = {
+    'name': 'item__name',
+    'quantity': 'quantity',
+}
+
+
+def parse_report_date(value, default):
+    """Parse a date filter of the report page, fall back to default"""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_int(value, default):
+    """Parse an integer request parameter, fall back to default"""
+    try:
+        return int(value)
+
+    except (TypeError, ValueError):
+        return default
+
+
+def get_report_filters(params):
+    """Extract report filters from request parameters"""
+    return {
+        'returnable': params.get('r'),
+        'non_returnable': params.get('nr'),
+        'start_date': params.get('sd', ''),
+        'end_date': params.get('ed', ''),
+        'keyword': params.get('kw', ''),
+    }
+
+
+def get_report_queryset(returnable, non_returnable, start_date, end_date, keyword='', items=None):
+    """
+    Build the report as one grouped query over the daily usage rollup,
+    every filter of the report page is applied in SQL. Items limits the
+    report to a range of item ids, first and last included.
+    """
+    start_date = parse_report_date(start_date, date.fromtimestamp(0))
+    end_date = parse_report_date(end_date, date.today() + timedelta(days=1))
+
+    # Creating filters for rollup rows
+    Q_set = Q(day__gte=start_date, day__lt=end_date, provisions__gt=0)
+
+    if keyword:
+        Q_set &= Q(item__name__icontains=keyword) | Q(item__description__icontains=keyword)
+
+    if returnable and not non_returnable:
+        Q_set &= Q(item__returnable=True)
+
+    elif non_returnable and not returnable:
+        Q_set &= Q(item__returnable=False)
+
+    if items:
+        Q_set &= Q(item__range=items)
+
+    return DailyUsage.objects.filter(Q_set).values(
+        'item',
+        'item__name',
+        'item__description',
+        'item__returnable'
+    ).annotate(
+        quantity=Sum('provisioned')
+    ).order_by('item__name')
+
+
+def report_row(values):
+    """Format a row of the report queryset for the report table"""
+    return {
+        'name': values['item__name'],
+        'description': values['item__description'],
+        'returnable': 'Yes' if values['item__returnable'] else 'No',
+        'quantity': values['quantity']
+    }
+
+
+def iter_report_rows(filters):
+    """Iterate over formatted report rows without loading them all in memory"""
+    for row in get_report_queryset(**filters).iterator():
+        yield report_row(row)
+
+
+def report_csv_values(row):
+    """Values of a report row as a CSV record"""
+    return [
+        row[field].encode('utf-8') if isinstance(row[field], unicode) else row[field]
+        for field in REPORT_FIELDS
+    ]
+
+
+def write_report_csv(rows, out, header=True):
+    """Write report rows to a file like object as CSV, return the number of rows"""
+    writer = csv.writer(out)
+    count = 0
+
+    if header:
+        writer.writerow(REPORT_FIELDS)
+
+    for row in rows:
+        writer.writerow(report_csv_values(row))
+        count += 1
+
+    return count
+
+
+def get_report_storage():
+    """Storage of report files, shared by all workers"""
+    return FileSystemStorage(location=settings.REPORT_FILES_ROOT)
+
+
+def get_report_chunks(size):
+    """Split the item id space in ranges of size ids, first and last included"""
+    bounds = Item.objects.aggregate(first=Min('id'), last=Max('id'))
+
+    # An empty catalog still makes one, empty, chunk
+    first = bounds['first'] or 0
+    last = bounds['last'] or 0
+
+    return [(start, min(start + size - 1, last)) for start in range(first, last + 1, size)]
+
+
+def compress_report_file(out):
+    """Gzip stream writing into a file like object, closing it leaves the file open"""
+    return gzip.GzipFile(fileobj=out, mode='wb', compresslevel=settings.REPORT_COMPRESSION_LEVEL)
+
+
+def open_report_file(storage, name):
+    """Open a report file of storage, decompressed as it is read when gzipped"""
+    report_file = storage.open(name)
+
+    if name.endswith('.gz'):
+        return report_file, gzip.GzipFile(fileobj=report_file, mode='rb')
+
+    return report_file, report_file
+
+
+def report_file_type(name):
+    """File name and content type a report file is sent with"""
+    if name.endswith('.gz'):
+        return 'Report.csv.gz', 'application/gzip'
+
+    return 'Report.csv', 'text/csv'
+
+
+def report_name_key(name):
+    """
+    Key chunk rows are sorted and merged by, the same in every chunk
+    whatever the collation the database orders names by
+    """
+    return name.lower(), name
+
+
+def write_report_chunk(filters, items, name):
+    """
+    Aggregate the report rows of a range of item ids into a gzipped CSV file
+    in report storage, sorted by report_name_key, return the name it was saved as
+    """
+    # A chunk holds at most REPORT_CHUNK_ITEMS rows, sorting them in memory is cheap
+    rows = sorted(iter_report_rows(dict(filters, items=items)), key=lambda row: report_name_key(row['name']))
+
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as chunk_file:
+        with compress_report_file(chunk_file) as stream:
+            write_report_csv(rows, stream, header=False)
+
+        chunk_file.seek(0)
+
+        return get_report_storage().save(name, File(chunk_file))
+
+
+def keyed_records(stream):
+    """CSV records of a chunk file along with the key they are sorted by"""
+    for record in csv.reader(stream):
+        yield report_name_key(record[0].decode('utf-8')), record
+
+
+def merge_report_chunks(names, out):
+    """
+    Merge chunk files into one report CSV, return the number of rows.
+    Chunks hold distinct items, so rows are only interleaved by name.
+    Chunk files are deleted once merged.
+    """
+    storage = get_report_storage()
+    chunk_files = [open_report_file(storage, name) for name in names]
+
+    try:
+        writer = csv.writer(out)
+        writer.writerow(REPORT_FIELDS)
+        count = 0
+
+        # Merged on the key each chunk was sorted by
+        for key, record in heapq.merge(*[keyed_records(stream) for chunk_file, stream in chunk_files]):
+            writer.writerow(record)
+            count += 1
+
+        return count
+
+    finally:
+        for chunk_file, stream in chunk_files:
+            stream.close()
+            chunk_file.close()
+
+        for name in names:
+            storage.delete(name)
+
+
+class Echo(object):
+    """File like object handing back what is written to it"""
+
+    def write(self, value):
+        return value
+
+
+def iter_report_csv(rows):
+    """Yield report rows as lines of CSV"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(REPORT_FIELDS)
+
+    for row in rows:
+        yield writer.writerow(report_csv_values(row))
+
+
+def iter_report_ndjson(rows):
+    """Yield report rows as lines of newline delimited JSON"""
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def order_report_queryset(queryset, column, direction):
+    """Order report rows by a column of the report table, ties broken by item"""
+    field = REPORT_ORDERING.get(column, REPORT_ORDERING['name'])
+
+    if direction == 'desc':
+        field = '-' + field
+
+    return queryset.order_by(field, 'item')
+
+
+def get_cached_report(params, generate):
+    """
+    Return report data for params from the shared cache, generating and
+    caching it on a miss. Cached reports are dropped by bumping the
+    report generation whenever provisions or items change.
+    """
+    key = 'report:{0}:{1}'.format(
+        get_generation('report'),
+        hashlib.md5(json.dumps(params, sort_keys=True)).hexdigest()
+    )
+    data = cache.get(key)
+
+    if data is None:
+        increment_counter('report_cache_misses')
+        data = generate()
+        cache.set(key, data, settings.REPORT_CACHE_TIMEOUT)
+
+    else:
+        increment_counter('report_cache_hits')
+
+    return data
+
+
+def get_report_cache_stats():
+    """Hits and misses of the report cache"""
+    return {
+        'hits': get_counter('report_cache_hits'),
+        'misses': get_counter('report_cache_misses'),
+    }
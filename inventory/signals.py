@@ -1,8 +1,39 @@
-from django.dispatch import Signal
+from contextlib import contextmanager
+import threading
 
-from inventory.tasks import send_mail_task
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from inventory.caching import bump_generation
+from inventory.models import DAILY_USAGE_FIELDS, User, Item, Provision, DailyUsage, OutboundMail
+from inventory.tasks import send_announcement_task
 
 send_mail_signal = Signal(providing_args=['mail_data', 'recipients', 'cc_to'])
+send_announcement_signal = Signal(providing_args=['mail_data'])
+
+# Mails collected by batched_mails in the current thread
+_batch = threading.local()
+
+
+@contextmanager
+def batched_mails():
+    """Queue all mails sent through send_mail_signal inside the block with one insert"""
+    if getattr(_batch, 'mails', None) is not None:
+        # Already batching, the outer block queues the mails
+        yield
+        return
+
+    _batch.mails = []
+
+    try:
+        yield
+        mails = _batch.mails
+
+    finally:
+        _batch.mails = None
+
+    if mails:
+        OutboundMail.objects.queue_many(mails)
 
 
 def send_mail(sender, mail_data, recipients, cc_to, **kwargs):
@@ -13,6 +44,99 @@ def send_mail(sender, mail_data, recipients, cc_to, **kwargs):
             'to': recipients,
             'cc': cc_to
         }
-        send_mail_task.delay(data)
 
-send_mail_signal.connect(send_mail)
\ No newline at end of file
+        # Queued in the outbox within the current transaction, a rolled back save sends nothing
+        if getattr(_batch, 'mails', None) is not None:
+            _batch.mails.append(data)
+        else:
+            OutboundMail.objects.queue(data)
+
+send_mail_signal.connect(send_mail)
+
+
+def send_announcement(sender, mail_data, **kwargs):
+    """Mail all users, the worker looks up and chunks the recipients"""
+    send_announcement_task.delay(mail_data)
+
+send_announcement_signal.connect(send_announcement)
+
+
+def daily_usage_values(provision):
+    """Values of a provision the daily usage rollup is summed from"""
+    return tuple(getattr(provision, field) for field in DAILY_USAGE_FIELDS)
+
+
+@receiver(pre_save, sender=Provision)
+def load_daily_usage_values(sender, instance, raw=False, **kwargs):
+    """Keep the values a provision counted with in the rollup until it is saved"""
+    if raw or instance.pk is None:
+        instance._daily_usage_values = None
+        return
+
+    instance._daily_usage_values = Provision.objects.filter(
+        id=instance.pk
+    ).values_list(*DAILY_USAGE_FIELDS).first()
+
+
+@receiver(post_save, sender=Provision)
+def update_daily_usage(sender, instance, raw=False, **kwargs):
+    """Move the provision's share of the rollup, reports read only from it"""
+    if raw:
+        return
+
+    DailyUsage.objects.change_provision(
+        getattr(instance, '_daily_usage_values', None),
+        daily_usage_values(instance)
+    )
+
+
+@receiver(post_delete, sender=Provision)
+def remove_daily_usage(sender, instance, **kwargs):
+    """Take a deleted provision out of the rollup, also when its user or item is deleted"""
+    DailyUsage.objects.change_provision(daily_usage_values(instance), None)
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(post_save, sender=Provision)
+@receiver(post_delete, sender=Provision)
+def invalidate_reports(sender, **kwargs):
+    """Drop cached reports whenever an item or a provision changes"""
+    bump_generation('report')
+
+
+@receiver(post_save, sender=Provision)
+@receiver(post_delete, sender=Provision)
+def invalidate_provision_dashboards(sender, instance, **kwargs):
+    """
+    Render again the dashboards showing a changed provision, the admin
+    scope is shared by all admins, so it is bumped again after the commit
+    """
+    bump_generation('dashboard:admin')
+    bump_generation('dashboard:user:{0}'.format(instance.user_id))
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_item_dashboards(sender, **kwargs):
+    """Render again all dashboards when an item changes"""
+    bump_generation('dashboard:items')
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_admins(sender, update_fields=None, **kwargs):
+    """Drop the cached admin recipients whenever a user changes"""
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+
+    bump_generation('admins')
+
+
+@receiver(post_save, sender=User)
+def invalidate_admin_dashboard(sender, update_fields=None, **kwargs):
+    """Admin dashboard shows users, render it again when one changes"""
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+
+    bump_generation('dashboard:admin')
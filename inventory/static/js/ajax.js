@@ -1,64 +1,105 @@
-$('#load_more_pending').click(function (event){
-    event.preventDefault();
-    var self = $(this),
-        url = self.attr("action"),
-        ajax_req = $.ajax({
-            url: url,
-            type: "GET",
-            data: {
-                load_more_pending: 'True',
-                is_admin: is_admin
-            },
-            success: function(data, textStatus, jqXHR){
-                var html_output = '';
-                $.each(data['pending'], function(key, value){
-                    html_output += '<tr><td>' + value['item_name'] + '</td>';
-                    html_output += '<td>' + value['description'] + '</td>';
-                    html_output += '<td>' + value['timestamp'] + '</td>';
-                    if(is_admin=='True'){
-                        html_output += '<td>' + value['user_email'] + '</td>';
-                        html_output += '<td><a href="' + provision_item_url + value['provision_id'] + '">Provision Item</a></td>';
-                    }
-
-                    html_output += '</tr>';
-                });
-                $('#pending_table').append(html_output);
-                self.remove();
+// Fetch the next page of a dashboard table, the button keeps the cursor of the next page
+function load_more(button, key, render_row){
+    if(button.data('loading')){
+        return;
+    }
+    button.data('loading', true);
+
+    var data = {
+        is_admin: is_admin,
+        cursor: button.data('cursor')
+    };
+    data['load_more_' + key] = 'True';
+
+    $.ajax({
+        url: button.attr("action"),
+        type: "GET",
+        data: data,
+        success: function(data, textStatus, jqXHR){
+            var html_output = '';
+            $.each(data[key], function(index, value){
+                html_output += render_row(value);
+            });
+            $('#' + key + '_table').append(html_output);
+
+            if(data['next_cursor']){
+                button.data('cursor', data['next_cursor']);
+                button.data('loading', false);
             }
-        });
-})
-
-$('#load_more_approved').click(function (event){
-    event.preventDefault();
-    var self = $(this),
-        url = self.attr("action"),
-        ajax_req = $.ajax({
-            url: url,
-            type: "GET",
-            data: {
-                load_more_approved: 'True',
-                is_admin: is_admin
-            },
-            success: function(data, textStatus, jqXHR){
-                var html_output = '';
-                $.each(data['approved'], function(key, value){
-                    html_output += '<tr><td>' + value['item_name'] + '</td><td>' + value['description'] + '</td><td>';
-                    html_output += value['returnable'] + '</td><td>' + value['return_by'] + '</td>';
-
-                    if(is_admin=='True'){
-                        html_output += '<td>' + value['user_email'] + '</td>';
-                        html_output += '<td>' + value['returned'] + '</td>';
-                        if(value['returned'] == 'N/A')
-                            html_output += '<td>N/A</td>';
-                        else
-                            html_output += '<td><a href="' + provision_list_url + value['provision_id'] +'">Mark Returned</a></td>';
-                    }
-                });
-                $('#approved_table').append(html_output);
-                self.remove();
+            else{
+                button.remove();
             }
-        });
-})
+        }
+    });
+}
+
+function render_pending_row(value){
+    var html_output = '<tr>';
+    if(is_admin=='True'){
+        html_output += '<td><input type="checkbox" name="provisions" value="' + value['provision_id'] + '"></td>';
+    }
+    html_output += '<td>' + value['item_name'] + '</td>';
+    html_output += '<td>' + value['description'] + '</td>';
+    html_output += '<td>' + value['timestamp'] + '</td>';
+    if(is_admin=='True'){
+        html_output += '<td>' + value['user_email'] + '</td>';
+        html_output += '<td><a href="' + provision_item_url + value['provision_id'] + '/">Provision Item</a></td>';
+    }
+
+    return html_output + '</tr>';
+}
+
+function render_approved_row(value){
+    var html_output = '<tr><td>' + value['item_name'] + '</td><td>' + value['description'] + '</td><td>';
+    html_output += value['returnable'] + '</td><td>' + value['return_by'] + '</td>';
+
+    if(is_admin=='True'){
+        html_output += '<td>' + value['user_email'] + '</td>';
+        html_output += '<td>' + value['returned'] + '</td>';
+        if(value['returned'] == 'N/A')
+            html_output += '<td>N/A</td>';
+        else
+            html_output += '<td><a href="' + provision_list_url + value['provision_id'] +'/">Mark Returned</a></td>';
+    }
+
+    return html_output + '</tr>';
+}
+
+var load_more_tables = {
+    pending: render_pending_row,
+    approved: render_approved_row
+};
+
+// First click loads a page, later pages load as the user scrolls down to the button
+$.each(load_more_tables, function(key, render_row){
+    $('#load_more_' + key).click(function (event){
+        event.preventDefault();
+        var self = $(this);
+        self.data('scroll', true).text('Loading...');
+        load_more(self, key, render_row);
+    });
+});
+
+// Select or clear every pending request loaded so far
+$('#select_all_pending').change(function(){
+    $('#pending_table input[name=provisions]').prop('checked', this.checked);
+});
+
+// Select or clear every provision on the page
+$('#select_all_provisions').change(function(){
+    $(this).closest('table').find('input[name=provisions]').prop('checked', this.checked);
+});
+
+$(window).scroll(function(){
+    var bottom = $(window).scrollTop() + $(window).height();
+
+    $.each(load_more_tables, function(key, render_row){
+        var button = $('#load_more_' + key);
+        if(button.length && button.data('scroll') && button.offset().top < bottom + 100){
+            load_more(button, key, render_row);
+        }
+    });
+});
 
 $('#profile_update_form :input[type=file]').change(function(event){
     var self = $(this),
@@ -1,36 +1,164 @@
-import StringIO
-import csv
+from datetime import datetime
+from itertools import islice
+import tempfile
+
+from celery import chord
 from celery.task import task
+from django.conf import settings
+from django.core.files import File
 from django.core.mail import EmailMessage
+from django.core.urlresolvers import reverse
+from django.db.models import F
 
+from inventory.digest import flush_admin_digest
+from inventory.mail import build_message, dispatch_outbox, send_message
+from inventory import metrics  # noqa, connects the task signals recording metrics
+from inventory.message_constants import report_link_mail, report_mail, empty_report_mail
+from inventory.models import ReportJob, User
+from inventory.reports import (
+    compress_report_file,
+    get_report_chunks,
+    get_report_storage,
+    merge_report_chunks,
+    report_file_type,
+    write_report_chunk
+)
 
-@task(name="send_report_mail")
-def send_report(data, email):
 
-    attachment_file = StringIO.StringIO()
-    data = data['csv']
-    writer = csv.DictWriter(attachment_file, data[0].keys())
-    writer.writeheader()
-    writer.writerows(data)
+def fail_report_job(job_id):
+    """Mark a report job failed, identical requests start a new one"""
+    ReportJob.objects.filter(id=job_id).update(status=ReportJob.FAILED, finished_on=datetime.now())
 
-    # Sending mail with attachment
-    mail = EmailMessage(
-        subject='Report',
-        body='Report attached',
-        to=[email],
+
+@task(name="run_report_job")
+def run_report_job(job_id):
+    """
+    Split the report of a job in ranges of items, each aggregated by its
+    own task so large reports spread over the workers, the last task to
+    finish merges them into the report file of the job
+    """
+    job = ReportJob.objects.get(id=job_id)
+    chunks = get_report_chunks(settings.REPORT_CHUNK_ITEMS)
+
+    ReportJob.objects.filter(id=job_id).update(status=ReportJob.RUNNING, chunks=len(chunks))
+
+    chord(
+        report_chunk_task.s(job_id, job.get_filters(), first, last) for first, last in chunks
+    )(merge_report_task.s(job_id))
+
+
+@task(name="report_chunk_task")
+def report_chunk_task(job_id, filters, first, last):
+    """Aggregate the report rows of a range of item ids into a chunk file"""
+    try:
+        name = write_report_chunk(filters, (first, last), 'chunks/{0}-{1}.csv.gz'.format(job_id, first))
+
+    except Exception:
+        fail_report_job(job_id)
+        raise
+
+    ReportJob.objects.filter(id=job_id).update(chunks_done=F('chunks_done') + 1)
+
+    return name
+
+
+@task(name="merge_report_task")
+def merge_report_task(names, job_id):
+    """Merge the chunk files of a report into the gzipped report file of the job"""
+    try:
+        # Rows are compressed as they are merged, the file stays in memory until it gets large
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as report_file:
+            with compress_report_file(report_file) as stream:
+                count = merge_report_chunks(names, stream)
+
+            report_file.seek(0)
+            artifact = get_report_storage().save('jobs/{0}.csv.gz'.format(job_id), File(report_file))
+
+    except Exception:
+        fail_report_job(job_id)
+        raise
+
+    ReportJob.objects.filter(id=job_id).update(
+        status=ReportJob.DONE,
+        rows=count,
+        artifact=artifact,
+        finished_on=datetime.now()
     )
-    mail.attach('Report.csv', attachment_file.getvalue(), 'text/csv')
-    mail.send()
+
+
+@task(
+    name="mail_report_task",
+    max_retries=settings.REPORT_JOB_TIMEOUT // settings.REPORT_MAIL_POLL_INTERVAL
+)
+def mail_report_task(job_id, email):
+    """Mail the report of a job as CSV, waiting for the job to finish"""
+    job = ReportJob.objects.get(id=job_id)
+
+    if job.status in (ReportJob.QUEUED, ReportJob.RUNNING):
+        raise mail_report_task.retry(countdown=settings.REPORT_MAIL_POLL_INTERVAL)
+
+    if job.status == ReportJob.FAILED:
+        return
+
+    if not job.rows:
+        send_message(EmailMessage(to=[email], **empty_report_mail()))
+        return
+
+    storage = get_report_storage()
+
+    # Large reports are linked to, rather than loaded in memory and pushed through the mail server
+    if storage.size(job.artifact) > settings.REPORT_ATTACHMENT_MAX_SIZE:
+        url = settings.REPORT_LINK_BASE_URL + reverse('report_job_download', args=[job.id])
+        send_message(EmailMessage(to=[email], **report_link_mail(url)))
+        return
+
+    # Sending mail with attachment
+    mail = EmailMessage(to=[email], **report_mail())
+    filename, content_type = report_file_type(job.artifact)
+
+    with storage.open(job.artifact) as report_file:
+        mail.attach(filename, report_file.read(), content_type)
+
+    send_message(mail)
 
 
 @task(name="send_mail_task")
 def send_mail_task(data):
+    """Send a mail over the connection kept open by this worker"""
+    send_message(build_message(data))
 
-    new_mail = EmailMessage(
-        subject=data['subject'],
-        body=data['body'],
-        to=data['to'],
-        cc=data['cc']
-    )
 
-    new_mail.send()
\ No newline at end of file
+@task(name="dispatch_outbox_task")
+def dispatch_outbox_task():
+    """Send mails queued in the outbox"""
+    return dispatch_outbox()
+
+
+@task(name="flush_admin_digest_task")
+def flush_admin_digest_task():
+    """Queue the digest mails of admins"""
+    return flush_admin_digest()
+
+
+@task(name="send_announcement_task")
+def send_announcement_task(mail_data):
+    """
+    Mail every user, recipients are streamed from the database and sent in
+    bcc chunks, each chunk as its own task so workers send them in parallel
+    """
+    emails = User.objects.order_by('id').values_list('email', flat=True).iterator()
+
+    while True:
+        chunk = [str(email) for email in islice(emails, settings.ANNOUNCEMENT_CHUNK_SIZE)]
+
+        if not chunk:
+            break
+
+        # Chunks are bulk work, kept off the notifications queue
+        send_mail_task.apply_async(args=[{
+            'subject': mail_data['subject'],
+            'body': mail_data['body'],
+            'to': [],
+            'cc': [],
+            'bcc': chunk
+        }], queue='bulk')
@@ -1,7 +1,35 @@
+from datetime import date, datetime, timedelta
+import gzip
+import hashlib
+import json
+import StringIO
+
+from celery import current_app
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse_lazy
-from django.test import TestCase
-from inventory.models import User, Item
+from django.db import transaction
+from django.forms import formset_factory
+from django.test import TestCase, override_settings
+from inventory.forms import (
+    AddItemForm,
+    BulkApproveForm,
+    ProvisionFormset,
+    ProvisionItemByRequestForm,
+    ProvisionItemForm,
+    ReturnItemForm
+)
+from inventory.models import User, Item, Provision, DailyUsage, OutboundMail, OutOfStock, AdminEvent, ReportJob
+from inventory.caching import bump_generation, check_shared_cache, dashboard_cache_version, get_generation
+from inventory.digest import admin_emails, flush_admin_digest
+from inventory.mail import close_pooled_connection, dispatch_outbox, get_pooled_connection
 from inventory.message_constants import *
+from inventory.reports import get_cached_report, get_report_cache_stats, get_report_filters, get_report_storage
+from inventory.signals import batched_mails, send_mail_signal
+from inventory.tasks import send_mail_task
+from inventory.views import ReportAjaxView
+from project_name.celery import QueueWorkerOptions
 
 
 class AnonymousTestCase(TestCase):
@@ -950,6 +978,578 @@ class ReportViewTestCase(TestCase):
         self.assertTrue('form' in resp.context)
 
 
+class ReportAjaxViewTestCase(TestCase):
+    """TestCase for report data served to the report page"""
+
+    def setUp(self):
+        """Setting up authentication and provisions before testing"""
+        cache.clear()
+
+        self.user = User.objects.create_user(
+            email='test@test.com',
+            password='test',
+            is_admin=True,
+        )
+
+        self.client.post(
+            reverse_lazy('login'),
+            {
+                'email': 'test@test.com',
+                'password': 'test'
+            },
+            follow=True
+        )
+
+        laptop = Item.objects.create(name='Laptop', description='Dell', returnable=True, quantity=10)
+        pen = Item.objects.create(name='Pen', description='Blue ink', returnable=False, quantity=10)
+        Item.objects.create(name='Mouse', description='Never issued', returnable=True, quantity=10)
+
+        approved_on = datetime.now() - timedelta(days=2)
+
+        for item, quantity in ((laptop, 2), (laptop, 3), (pen, 4)):
+            Provision.objects.create(
+                item=item,
+                user=self.user,
+                approved=True,
+                approved_on=approved_on,
+                quantity=quantity
+            )
+
+        call_command('rebuild_daily_usage', stdout=StringIO.StringIO())
+
+    def get_report(self, **params):
+        """Fetch report rows via AJAX"""
+        resp = self.client.get(
+            reverse_lazy('report_ajax'),
+            params,
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.content)['data']
+
+    @staticmethod
+    def decompress(content):
+        """Content of a gzipped report file"""
+        return gzip.GzipFile(fileobj=StringIO.StringIO(content)).read()
+
+    def test_report_data(self):
+        """Quantities are summed per item, items never provisioned are left out"""
+        data = self.get_report()
+
+        self.assertEqual(data, [
+            {'name': 'Laptop', 'description': 'Dell', 'returnable': 'Yes', 'quantity': 5},
+            {'name': 'Pen', 'description': 'Blue ink', 'returnable': 'No', 'quantity': 4},
+        ])
+
+    def test_report_filters(self):
+        """Returnable, keyword and date filters narrow the report"""
+        self.assertEqual([row['name'] for row in self.get_report(r='true')], ['Laptop'])
+        self.assertEqual([row['name'] for row in self.get_report(nr='true')], ['Pen'])
+
+        start_date = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+        self.assertEqual(self.get_report(sd=start_date), [])
+
+    def test_report_server_side_page(self):
+        """DataTables server-side requests get one ordered page and the counts"""
+        resp = self.client.get(
+            reverse_lazy('report_ajax'),
+            {
+                'draw': '3',
+                'start': '1',
+                'length': '1',
+                'columns[0][data]': 'name',
+                'columns[3][data]': 'quantity',
+                'order[0][column]': '3',
+                'order[0][dir]': 'desc',
+                'search[value]': '',
+            },
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        data = json.loads(resp.content)
+
+        self.assertEqual(data['draw'], 3)
+        self.assertEqual(data['recordsTotal'], 2)
+        self.assertEqual(data['recordsFiltered'], 2)
+        self.assertEqual([row['name'] for row in data['data']], ['Pen'])
+
+        # Searching filters the rows but not the total
+        resp = self.client.get(
+            reverse_lazy('report_ajax'),
+            {'draw': '4', 'start': '0', 'length': '25', 'search[value]': 'ink'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        data = json.loads(resp.content)
+
+        self.assertEqual(data['recordsTotal'], 2)
+        self.assertEqual(data['recordsFiltered'], 1)
+        self.assertEqual([row['name'] for row in data['data']], ['Pen'])
+
+    def test_report_page_length_clamped(self):
+        """Pages asking for all rows, or more than the largest page, get the largest page"""
+        for i in range(ReportAjaxView.max_page_length + 1):
+            item = Item.objects.create(name='Item {0:03d}'.format(i), returnable=False, quantity=1)
+            Provision.objects.create(item=item, user=self.user, approved=True, approved_on=datetime.now(), quantity=1)
+
+        for length in ('-1', '1000'):
+            resp = self.client.get(
+                reverse_lazy('report_ajax'),
+                {'draw': '1', 'start': '0', 'length': length},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+            )
+            data = json.loads(resp.content)
+
+            self.assertEqual(data['recordsTotal'], ReportAjaxView.max_page_length + 3)
+            self.assertEqual(len(data['data']), ReportAjaxView.max_page_length)
+
+    def test_report_mail(self):
+        """Mailing a report only sends filters, the worker builds the CSV"""
+        resp = self.client.post(
+            reverse_lazy('report_ajax'),
+            {'r': 'true', 'kw': 'dell'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.assertEqual(json.loads(resp.content)['message'], REPORT_QUEUED_MESSAGE)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['test@test.com'])
+
+        name, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual((name, mimetype), ('Report.csv.gz', 'application/gzip'))
+        self.assertEqual(self.decompress(content).splitlines(), [
+            'name,description,returnable,quantity',
+            'Laptop,Dell,Yes,5',
+        ])
+
+    @override_settings(REPORT_CHUNK_ITEMS=1)
+    def test_report_chunks_order(self):
+        """Chunks are sorted and merged by the same key, whatever the database collation"""
+        banana = Item.objects.create(name='banana', returnable=False, quantity=10)
+        Provision.objects.create(
+            item=banana,
+            user=self.user,
+            approved=True,
+            approved_on=datetime.now() - timedelta(days=1),
+            quantity=1
+        )
+        call_command('rebuild_daily_usage', stdout=StringIO.StringIO())
+
+        self.client.post(reverse_lazy('report_ajax'), {}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        name, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual(
+            [line.split(',')[0] for line in self.decompress(content).splitlines()[1:]],
+            ['banana', 'Laptop', 'Pen']
+        )
+
+    @override_settings(REPORT_ATTACHMENT_MAX_SIZE=0, REPORT_LINK_BASE_URL='https://inventory.test')
+    def test_report_mail_link(self):
+        """Reports too large to attach are mailed as a download link"""
+        self.client.post(reverse_lazy('report_ajax'), {}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        job = ReportJob.objects.get()
+        self.assertEqual(mail.outbox[0].attachments, [])
+        self.assertIn(
+            'https://inventory.test{0}'.format(reverse_lazy('report_job_download', args=[job.id])),
+            mail.outbox[0].body
+        )
+
+    @override_settings(REPORT_CHUNK_ITEMS=1)
+    def test_report_chunks(self):
+        """Mailed reports are aggregated per range of items and merged in order"""
+        resp = self.client.post(
+            reverse_lazy('report_ajax'),
+            {},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+        name, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual(self.decompress(content).splitlines(), [
+            'name,description,returnable,quantity',
+            'Laptop,Dell,Yes,5',
+            'Pen,Blue ink,No,4',
+        ])
+
+        # One chunk per item, polled as done once merged
+        resp = self.client.get(
+            json.loads(resp.content)['status_url'],
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        data = json.loads(resp.content)
+        self.assertEqual(
+            (data['status'], data['chunks'], data['chunks_done'], data['percent'], data['rows']),
+            ('done', 3, 3, 100, 2)
+        )
+
+        # Chunk files are gone once merged
+        self.assertEqual(get_report_storage().listdir('chunks'), ([], []))
+
+    def test_report_jobs(self):
+        """Identical report requests share a job, its file is downloaded again as generated"""
+        def start_job(**params):
+            resp = self.client.post(reverse_lazy('report_jobs'), params, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            return json.loads(resp.content)
+
+        resp = self.client.get(start_job(nr='true')['status_url'], HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = json.loads(resp.content)
+        self.assertEqual((data['status'], data['rows']), ('done', 1))
+
+        # Nothing changed since, the finished job is reused
+        self.assertEqual(start_job(nr='true')['id'], data['id'])
+        self.assertNotEqual(start_job(r='true')['id'], data['id'])
+
+        # Requests identical to a job still running join it
+        ReportJob.objects.filter(id=data['id']).update(status=ReportJob.RUNNING)
+        Item.objects.get(name='Pen').save()
+        self.assertEqual(start_job(nr='true')['id'], data['id'])
+
+        ReportJob.objects.filter(id=data['id']).update(status=ReportJob.DONE)
+        resp = self.client.get(data['download_url'])
+        self.assertEqual(resp['Content-Disposition'], 'attachment; filename="Report.csv.gz"')
+        self.assertEqual(self.decompress(''.join(resp.streaming_content)).splitlines(), [
+            'name,description,returnable,quantity',
+            'Pen,Blue ink,No,4',
+        ])
+
+        # Reports changed since the job finished, a new job is started
+        new_data = start_job(nr='true')
+        self.assertNotEqual(new_data['id'], data['id'])
+        self.assertEqual(ReportJob.objects.count(), 3)
+
+    def test_report_job_created_once(self):
+        """A request identical to one creating a job waits for that job instead of creating another"""
+        filters = get_report_filters({'nr': 'true'})
+        params = json.dumps(filters, sort_keys=True)
+        params_hash = hashlib.md5(params).hexdigest()
+        lock = 'report-job-lock:{0}'.format(params_hash)
+
+        # Held by an identical request, creating its job while this one waits
+        cache.add(lock, True)
+
+        def create_meanwhile():
+            ReportJob.objects.create(params=params, params_hash=params_hash, generation=get_generation('report'))
+            cache.delete(lock)
+
+        ReportJob.objects.wait_for_lock = create_meanwhile
+
+        try:
+            job, created = ReportJob.objects.get_or_create_for(filters, self.user, get_generation('report'), 60)
+
+        finally:
+            del ReportJob.objects.wait_for_lock
+
+        self.assertFalse(created)
+        self.assertEqual(ReportJob.objects.get(), job)
+        self.assertIsNone(cache.get(lock))
+
+    def test_report_download(self):
+        """Reports are streamed as CSV or newline delimited JSON"""
+        resp = self.client.get(reverse_lazy('report_download'), {'nr': 'true'})
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp['Content-Type'], 'text/csv')
+        self.assertEqual(''.join(resp.streaming_content).splitlines(), [
+            'name,description,returnable,quantity',
+            'Pen,Blue ink,No,4',
+        ])
+
+        resp = self.client.get(reverse_lazy('report_download'), {'format': 'ndjson'})
+        rows = [json.loads(line) for line in ''.join(resp.streaming_content).splitlines()]
+        self.assertEqual([(row['name'], row['quantity']) for row in rows], [('Laptop', 5), ('Pen', 4)])
+
+        resp = self.client.get(reverse_lazy('report_download'), {'format': 'xml'})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_report_cache(self):
+        """Repeated reports come from cache until a provision or item is saved"""
+        view = ReportAjaxView()
+        data = view.get_report_data('', '', '', '')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(view.get_report_data('', '', '', ''), data)
+
+        self.assertEqual(get_report_cache_stats(), {'hits': 1, 'misses': 1})
+
+        # Saving an item invalidates cached reports
+        Item.objects.get(name='Pen').save()
+
+        with self.assertNumQueries(1):
+            view.get_report_data('', '', '', '')
+
+        self.assertEqual(get_report_cache_stats(), {'hits': 1, 'misses': 2})
+
+    def test_report_query_count(self):
+        """The report costs the same number of queries whatever the catalog size"""
+        with self.assertNumQueries(1):
+            ReportAjaxView().get_report_data('', '', '', '')
+
+        for i in range(10):
+            item = Item.objects.create(name='Item {}'.format(i), returnable=True, quantity=10)
+            Provision.objects.create(
+                item=item,
+                user=self.user,
+                approved=True,
+                approved_on=datetime.now() - timedelta(days=1),
+                quantity=1
+            )
+
+        call_command('rebuild_daily_usage', stdout=StringIO.StringIO())
+
+        with self.assertNumQueries(1):
+            ReportAjaxView().get_report_data('', '', '', '')
+
+
+class DailyUsageTestCase(TestCase):
+    """TestCase for the daily usage rollup kept by provision saves and deletes"""
+
+    def setUp(self):
+        """Creating an item and a pending request for it"""
+        self.user = User.objects.create_user('test@test.com', 'test')
+        self.item = Item.objects.create(name='Laptop', returnable=True, quantity=10)
+        self.provision = Provision.objects.create(item=self.item, user=self.user)
+
+    def test_rollup_maintained_by_forms(self):
+        """Approving a request and returning it updates today's rollup row"""
+        form = ProvisionItemByRequestForm({'item': self.item.id}, instance=self.provision)
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        usage = DailyUsage.objects.get(item=self.item, day=date.today())
+        self.assertEqual((usage.provisioned, usage.provisions, usage.returned), (1, 1, 0))
+
+        ReturnItemForm({}, instance=Provision.objects.get(id=self.provision.id)).save()
+
+        usage = DailyUsage.objects.get(item=self.item, day=date.today())
+        self.assertEqual((usage.provisioned, usage.provisions, usage.returned), (1, 1, 1))
+
+    def test_rollup_follows_edits(self):
+        """Editing an approved provision, as the admin site does, moves its share of the rollup"""
+        form = ProvisionItemByRequestForm({'item': self.item.id}, instance=self.provision)
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        provision = Provision.objects.get(id=self.provision.id)
+        provision.quantity = 3
+        provision.approved_on = datetime.now() - timedelta(days=1)
+        provision.save()
+
+        usage = DailyUsage.objects.get(item=self.item, day=date.today())
+        self.assertEqual((usage.provisioned, usage.provisions, usage.returned), (0, 0, 0))
+
+        usage = DailyUsage.objects.get(item=self.item, day=date.today() - timedelta(days=1))
+        self.assertEqual((usage.provisioned, usage.provisions, usage.returned), (3, 1, 0))
+
+    def test_rollup_follows_deletes(self):
+        """Deleting a user takes their provisions out of the rollup and the report"""
+        cache.clear()
+
+        form = ProvisionItemByRequestForm({'item': self.item.id}, instance=self.provision)
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        self.assertEqual(len(ReportAjaxView().get_report_data('', '', '', '')['data']), 1)
+
+        self.user.delete()
+
+        usage = DailyUsage.objects.get(item=self.item, day=date.today())
+        self.assertEqual((usage.provisioned, usage.provisions, usage.returned), (0, 0, 0))
+        self.assertEqual(ReportAjaxView().get_report_data('', '', '', '')['data'], [])
+
+    def test_rollup_item_deleted(self):
+        """Deleting an item deletes its rollup rows, none is created again for its provisions"""
+        form = ProvisionItemByRequestForm({'item': self.item.id}, instance=self.provision)
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        self.item.delete()
+
+        self.assertFalse(DailyUsage.objects.exists())
+
+    def test_rebuild_command(self):
+        """Rebuilding the rollup from history matches the provision table"""
+        Provision.objects.filter(id=self.provision.id).update(
+            approved=True,
+            approved_on=datetime.now(),
+            quantity=3
+        )
+        DailyUsage.objects.add_provisions(self.item.id, date.today(), 100)
+
+        call_command('rebuild_daily_usage', stdout=StringIO.StringIO())
+
+        usage = DailyUsage.objects.get()
+        self.assertEqual((usage.provisioned, usage.provisions, usage.returned), (3, 1, 0))
+
+
+class ItemStockTestCase(TestCase):
+    """TestCase for stock updates made by provisioning and returning"""
+
+    def setUp(self):
+        """Creating an item with little stock and a pending request for it"""
+        self.user = User.objects.create_user('test@test.com', 'test')
+        self.item = Item.objects.create(name='Laptop', returnable=True, quantity=2)
+        self.provision = Provision.objects.create(item=self.item, user=self.user)
+
+    def test_take_stock(self):
+        """Stock is decremented but never below zero"""
+        Item.objects.take_stock(self.item, 2)
+        self.assertEqual(Item.objects.get(id=self.item.id).quantity, 0)
+
+        with self.assertRaises(OutOfStock):
+            Item.objects.take_stock(self.item, 1)
+        self.assertEqual(Item.objects.get(id=self.item.id).quantity, 0)
+
+        Item.objects.restock(self.item, 3)
+        self.assertEqual(Item.objects.get(id=self.item.id).quantity, 3)
+
+    def test_stock_taken_meanwhile(self):
+        """Approving a request for an item emptied after validation saves nothing"""
+        form = ProvisionItemByRequestForm({'item': self.item.id}, instance=self.provision)
+        self.assertTrue(form.is_valid())
+
+        Item.objects.filter(id=self.item.id).update(quantity=0)
+
+        with self.assertRaises(OutOfStock):
+            form.save()
+
+        self.assertFalse(Provision.objects.get(id=self.provision.id).approved)
+        self.assertFalse(DailyUsage.objects.exists())
+
+
+class LoadMoreViewTestCase(TestCase):
+    """TestCase for paging through dashboard tables"""
+
+    def setUp(self):
+        """Logging in a user with 30 pending requests"""
+        cache.clear()
+
+        self.user = User.objects.create_user('test@test.com', 'test')
+        item = Item.objects.create(name='Laptop', returnable=True, quantity=10)
+
+        for i in range(30):
+            Provision.objects.create(item=item, user=self.user)
+
+        self.client.post(
+            reverse_lazy('login'),
+            {
+                'email': 'test@test.com',
+                'password': 'test'
+            },
+            follow=True
+        )
+
+    def load_more(self, cursor):
+        """Fetch a page of pending requests after cursor"""
+        resp = self.client.get(
+            reverse_lazy('load_more_ajax'),
+            {'load_more_pending': 'True', 'is_admin': 'False', 'cursor': cursor},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.content)
+
+    def test_load_more_pages(self):
+        """Pages follow the dashboard rows without gaps or repeats"""
+        resp = self.client.get(reverse_lazy('dashboard'))
+        seen = [p.id for p in resp.context['pending']]
+
+        data = self.load_more(resp.context['pending'].cursor)
+        self.assertEqual(len(data['pending']), 20)
+        seen += [p['provision_id'] for p in data['pending']]
+
+        data = self.load_more(data['next_cursor'])
+        self.assertEqual(len(data['pending']), 5)
+        self.assertEqual(data['next_cursor'], None)
+        seen += [p['provision_id'] for p in data['pending']]
+
+        self.assertEqual(seen, list(Provision.objects.order_by('timestamp', 'id').values_list('id', flat=True)))
+
+    def test_load_more_bad_cursor(self):
+        """A malformed cursor is not found"""
+        resp = self.client.get(
+            reverse_lazy('load_more_ajax'),
+            {'load_more_pending': 'True', 'cursor': 'nonsense'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.assertEqual(resp.status_code, 404)
+
+
+class DashboardQueryBudgetTestCase(TestCase):
+    """TestCase for the number of queries the dashboard costs"""
+
+    def setUp(self):
+        """Logging in an admin who has pending and approved provisions"""
+        cache.clear()
+
+        self.user = User.objects.create_user('test@test.com', 'test', is_admin=True)
+
+        for i in range(8):
+            item = Item.objects.create(name='Item {}'.format(i), returnable=True, quantity=10)
+            other = User.objects.create_user('user{}@test.com'.format(i), 'test')
+
+            for user in (self.user, other):
+                Provision.objects.create(item=item, user=user)
+                Provision.objects.create(item=item, user=user, approved=True, approved_on=datetime.now())
+
+        self.client.post(
+            reverse_lazy('login'),
+            {
+                'email': 'test@test.com',
+                'password': 'test'
+            },
+            follow=True
+        )
+
+    def assert_dashboard_queries(self, params):
+        """Dashboard rows, users and items come from two queries in all"""
+        # Logging in rendered the dashboard, measuring without its cached tables
+        bump_generation('dashboard:items')
+
+        # Loading the logged in user, then one query per table
+        with self.assertNumQueries(3):
+            resp = self.client.get(reverse_lazy('dashboard'), params)
+
+        self.assertEqual(len(resp.context['pending']), 5)
+        self.assertEqual(len(resp.context['approved']), 5)
+        self.assertTrue(resp.context['pending'].more)
+        self.assertTrue(resp.context['approved'].more)
+
+    def test_admin_dashboard_queries(self):
+        """Admin dashboard has a fixed query budget"""
+        self.assert_dashboard_queries({})
+
+    def test_user_dashboard_queries(self):
+        """User dashboard of an admin has a fixed query budget"""
+        self.assert_dashboard_queries({'user': 'True'})
+
+    def test_dashboard_fragment_cache(self):
+        """Repeat loads do no provision queries until a shown provision changes"""
+        item = Item.objects.create(name='Fresh item', returnable=True, quantity=10)
+
+        self.client.get(reverse_lazy('dashboard'))
+        self.client.get(reverse_lazy('dashboard'), {'user': 'True'})
+
+        # Only the logged in user is loaded
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse_lazy('dashboard'))
+        self.assertNotContains(resp, 'Fresh item')
+
+        with self.assertNumQueries(1):
+            self.client.get(reverse_lazy('dashboard'), {'user': 'True'})
+
+        # A provision of another user changes the admin dashboard only
+        Provision.objects.create(
+            item=item,
+            user=User.objects.get(email='user0@test.com'),
+            approved=True,
+            approved_on=datetime.now()
+        )
+
+        resp = self.client.get(reverse_lazy('dashboard'))
+        self.assertContains(resp, 'Fresh item')
+
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse_lazy('dashboard'), {'user': 'True'})
+        self.assertNotContains(resp, 'Fresh item')
+
+
 class ProvisionViewTestCase(TestCase):
     """TestCase for report page"""
 
@@ -983,4 +1583,496 @@ class ProvisionViewTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
 
         # Checking if form is present in context
-        self.assertTrue('formset' in resp.context)
\ No newline at end of file
+        self.assertTrue('formset' in resp.context)
+
+
+class ProvisionFormsetTestCase(TestCase):
+    """TestCase for provisioning many rows at once"""
+
+    def setUp(self):
+        """Creating an admin, two users and two items"""
+        self.admin = User.objects.create_user('admin@test.com', 'test', is_admin=True)
+        self.users = [
+            User.objects.create_user('first@test.com', 'test'),
+            User.objects.create_user('second@test.com', 'test'),
+        ]
+        self.items = [
+            Item.objects.create(name='Pen', returnable=False, quantity=100),
+            Item.objects.create(name='Notebook', returnable=False, quantity=100),
+        ]
+
+    def get_formset(self, rows):
+        """Bound formset provisioning one of every item to alternating users"""
+        data = {
+            'form-TOTAL_FORMS': str(rows),
+            'form-INITIAL_FORMS': '0',
+            'form-MAX_NUM_FORMS': '1000',
+        }
+        for i in range(rows):
+            data['form-{0}-item'.format(i)] = self.items[i % 2].id
+            data['form-{0}-user'.format(i)] = self.users[i // 2 % 2].id
+            data['form-{0}-quantity'.format(i)] = '1'
+
+        return formset_factory(ProvisionItemForm, formset=ProvisionFormset)(data)
+
+    def test_bulk_save(self):
+        """Saving 20 rows takes a fixed number of queries and one mail per user"""
+        formset = self.get_formset(20)
+        self.assertTrue(formset.is_valid())
+
+        # Stock updates, rollup rows and savepoints grow with items, not with rows
+        with self.assertNumQueries(17):
+            formset.save()
+
+        self.assertEqual(Provision.objects.filter(approved=True).count(), 20)
+        self.assertEqual([item.quantity for item in Item.objects.order_by('id')], [90, 90])
+        self.assertEqual(
+            sorted(DailyUsage.objects.values_list('provisioned', 'provisions')),
+            [(10, 10), (10, 10)]
+        )
+
+        # Mails are queued with one insert and sent by the dispatcher
+        self.assertEqual(OutboundMail.objects.count(), 2)
+        dispatch_outbox()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].cc, ['admin@test.com'])
+
+    def test_validation_queries(self):
+        """Validating rows loads items and users once for all forms"""
+        formset = self.get_formset(20)
+
+        with self.assertNumQueries(2):
+            self.assertTrue(formset.is_valid())
+
+        # Every form got the same instances
+        self.assertEqual(len({id(form.cleaned_data['item']) for form in formset}), 2)
+
+    def test_total_quantity_checked(self):
+        """Rows of one item cannot take more than its stock together"""
+        Item.objects.filter(id=self.items[0].id).update(quantity=5)
+        formset = self.get_formset(20)
+
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(
+            formset.non_form_errors(),
+            ['The available quantity for item Pen is only 5']
+        )
+
+    def test_out_of_stock_rolls_back(self):
+        """Nothing is saved when one item ran out after validation"""
+        formset = self.get_formset(4)
+        self.assertTrue(formset.is_valid())
+
+        Item.objects.filter(id=self.items[1].id).update(quantity=1)
+
+        with self.assertRaises(OutOfStock):
+            formset.save()
+
+        self.assertFalse(Provision.objects.exists())
+        self.assertEqual(Item.objects.get(id=self.items[0].id).quantity, 100)
+        self.assertFalse(OutboundMail.objects.exists())
+
+
+class BulkApproveViewTestCase(TestCase):
+    """TestCase for approving many pending requests at once"""
+
+    def setUp(self):
+        """Logging in as admin, creating requests for more laptops than in stock"""
+        User.objects.create_user('admin@test.com', 'test', is_admin=True)
+        self.user = User.objects.create_user('test@test.com', 'test')
+        self.laptop = Item.objects.create(name='Laptop', returnable=True, quantity=2)
+        self.mouse = Item.objects.create(name='Mouse', returnable=True, quantity=5)
+
+        self.requests = [
+            Provision.objects.create(item=self.laptop, user=self.user),
+            Provision.objects.create(item=self.mouse, user=self.user),
+            Provision.objects.create(item=self.laptop, user=self.user),
+            Provision.objects.create(item=self.laptop, user=self.user),
+        ]
+
+        self.client.post(reverse_lazy('login'), {'email': 'admin@test.com', 'password': 'test'}, follow=True)
+
+    def test_bulk_approve(self):
+        """Requests are approved oldest first while stock lasts, the rest are reported"""
+        resp = self.client.post(
+            reverse_lazy('bulk_approve'),
+            {'provisions': [provision.id for provision in self.requests]},
+            follow=True
+        )
+
+        messages = [str(message) for message in resp.context['messages']]
+        self.assertEqual(messages, [
+            bulk_approve_message(3),
+            bulk_approve_failed_message([('Laptop', 'test@test.com')]),
+        ])
+
+        approved = Provision.objects.filter(approved=True).order_by('id')
+        self.assertEqual(list(approved), self.requests[:3])
+        self.assertEqual(Item.objects.get(id=self.laptop.id).quantity, 0)
+        self.assertEqual(Item.objects.get(id=self.mouse.id).quantity, 4)
+
+        # One mail for the user, listing every approved item
+        dispatch_outbox()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(DailyUsage.objects.get(item=self.laptop).provisions, 2)
+
+    def test_approved_meanwhile(self):
+        """Requests approved since the dashboard loaded are reported, the others still approved"""
+        Provision.objects.filter(id=self.requests[1].id).update(approved=True, approved_on=datetime.now(), quantity=1)
+
+        resp = self.client.post(
+            reverse_lazy('bulk_approve'),
+            {'provisions': [self.requests[0].id, self.requests[1].id]},
+            follow=True
+        )
+
+        messages = [str(message) for message in resp.context['messages']]
+        self.assertEqual(messages, [
+            bulk_approve_message(1),
+            bulk_approve_skipped_message([('Mouse', 'test@test.com')]),
+        ])
+        self.assertTrue(Provision.objects.get(id=self.requests[0].id).approved)
+        self.assertEqual(Item.objects.get(id=self.mouse.id).quantity, 5)
+
+    def test_bulk_approve_timestamp(self):
+        """Bulk approved requests move to their approval time, like single approvals"""
+        Provision.objects.filter(id=self.requests[0].id).update(timestamp=datetime.now() - timedelta(days=1))
+
+        self.client.post(reverse_lazy('bulk_approve'), {'provisions': [self.requests[0].id]})
+
+        provision = Provision.objects.get(id=self.requests[0].id)
+        self.assertEqual(provision.timestamp, provision.approved_on)
+
+    def test_nothing_selected(self):
+        """Posting no requests approves nothing"""
+        resp = self.client.post(reverse_lazy('bulk_approve'), follow=True)
+
+        messages = [str(message) for message in resp.context['messages']]
+        self.assertEqual(messages, [NO_REQUESTS_SELECTED_MESSAGE])
+        self.assertFalse(Provision.objects.filter(approved=True).exists())
+
+
+class BulkReturnViewTestCase(TestCase):
+    """TestCase for marking many provisions returned at once"""
+
+    def setUp(self):
+        """Logging in as admin, provisioning laptops and mice to two users"""
+        User.objects.create_user('admin@test.com', 'test', is_admin=True)
+        users = [
+            User.objects.create_user('first@test.com', 'test'),
+            User.objects.create_user('second@test.com', 'test'),
+        ]
+        self.laptop = Item.objects.create(name='Laptop', returnable=True, quantity=0)
+        self.mouse = Item.objects.create(name='Mouse', returnable=True, quantity=0)
+
+        self.provisions = [
+            Provision.objects.create(item=item, user=user, quantity=2, approved=True, approved_on=datetime.now())
+            for item in (self.laptop, self.mouse)
+            for user in users
+        ]
+
+        self.client.post(reverse_lazy('login'), {'email': 'admin@test.com', 'password': 'test'}, follow=True)
+
+    def test_bulk_return(self):
+        """Selected provisions are marked returned and stock is restored per item"""
+        resp = self.client.post(
+            reverse_lazy('bulk_return'),
+            {'provisions': [provision.id for provision in self.provisions[:3]]},
+            follow=True
+        )
+
+        messages = [str(message) for message in resp.context['messages']]
+        self.assertEqual(messages, [bulk_return_message(3)])
+
+        self.assertEqual(Provision.objects.filter(returned=True).count(), 3)
+        self.assertEqual(Item.objects.get(id=self.laptop.id).quantity, 4)
+        self.assertEqual(Item.objects.get(id=self.mouse.id).quantity, 2)
+        self.assertEqual(DailyUsage.objects.get(item=self.laptop).returned, 4)
+
+        # One mail for each user
+        dispatch_outbox()
+        self.assertEqual(len(mail.outbox), 2)
+
+        # Only the provision left outstanding is listed
+        self.assertEqual(list(resp.context['object_list']), self.provisions[3:])
+
+    def test_bulk_return_timestamp(self):
+        """Bulk returned provisions move to their return time, like single returns"""
+        Provision.objects.filter(id=self.provisions[0].id).update(timestamp=datetime.now() - timedelta(days=1))
+
+        self.client.post(reverse_lazy('bulk_return'), {'provisions': [self.provisions[0].id]})
+
+        provision = Provision.objects.get(id=self.provisions[0].id)
+        self.assertEqual(provision.timestamp, provision.returned_on)
+
+    def test_provision_list(self):
+        """Provision list shows outstanding provisions oldest first, on one page when few"""
+        resp = self.client.get(reverse_lazy('provision_list'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.context['is_paginated'])
+        self.assertEqual(list(resp.context['object_list']), self.provisions)
+
+
+class MailBatchTestCase(TestCase):
+    """TestCase for mails queued in the outbox, in batches and in chunks"""
+
+    def send_mails(self, count):
+        """Send mails through send_mail_signal"""
+        for i in range(count):
+            send_mail_signal.send(
+                sender=Provision,
+                mail_data=item_returned_mail('test@test.com'),
+                recipients=['user{0}@test.com'.format(i)],
+                cc_to=[]
+            )
+
+    def test_batched_mails(self):
+        """Mails sent inside a batch are queued together once the block ends"""
+        with self.assertNumQueries(1):
+            with batched_mails():
+                self.send_mails(3)
+
+        self.assertEqual(dispatch_outbox(), 3)
+        self.assertEqual(
+            [message.to for message in mail.outbox],
+            [['user0@test.com'], ['user1@test.com'], ['user2@test.com']]
+        )
+
+    def test_pooled_connection(self):
+        """Tasks reuse the connection of the process until it is closed"""
+        connection = get_pooled_connection()
+        self.assertIs(get_pooled_connection(), connection)
+
+        close_pooled_connection()
+        self.assertIsNot(get_pooled_connection(), connection)
+
+    def test_outbox_claims(self):
+        """A claimed batch is not handed out again while its lease lasts"""
+        self.send_mails(3)
+
+        self.assertEqual(len(OutboundMail.objects.claim_batch(2, 60, 5)), 2)
+        self.assertEqual(len(OutboundMail.objects.claim_batch(2, 60, 5)), 1)
+        self.assertEqual(OutboundMail.objects.claim_batch(2, 60, 5), [])
+
+    @override_settings(
+        EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+        EMAIL_HOST='127.0.0.1',
+        EMAIL_PORT=1,
+        EMAIL_USE_TLS=False
+    )
+    def test_outbox_retry(self):
+        """A mail failing to send stays queued for a later attempt"""
+        self.send_mails(1)
+        close_pooled_connection()
+
+        try:
+            self.assertEqual(dispatch_outbox(), 0)
+
+        finally:
+            close_pooled_connection()
+
+        outbound_mail = OutboundMail.objects.get()
+        self.assertEqual(outbound_mail.attempts, 1)
+        self.assertIsNone(outbound_mail.sent_on)
+        self.assertTrue(outbound_mail.next_attempt_on > datetime.now())
+
+    def test_outbox_bad_row(self):
+        """A mail that cannot be built fails alone, mails sent around it are not sent again"""
+        self.send_mails(1)
+        OutboundMail.objects.create(data='not json')
+        self.send_mails(1)
+
+        self.assertEqual(dispatch_outbox(), 2)
+        self.assertEqual(len(mail.outbox), 2)
+
+        bad_mail = OutboundMail.objects.get(data='not json')
+        self.assertEqual(bad_mail.attempts, 1)
+        self.assertIsNone(bad_mail.sent_on)
+        self.assertEqual(OutboundMail.objects.filter(sent_on__isnull=False).count(), 2)
+
+        # Bad row is due again once its retry delay passed, only it is attempted
+        OutboundMail.objects.filter(id=bad_mail.id).update(next_attempt_on=datetime.now())
+        self.assertEqual(dispatch_outbox(), 0)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(OutboundMail.objects.get(id=bad_mail.id).attempts, 2)
+
+    @override_settings(ANNOUNCEMENT_CHUNK_SIZE=2)
+    def test_announcement_chunks(self):
+        """A new item is announced to all users in bcc chunks"""
+        for i in range(5):
+            User.objects.create_user('user{0}@test.com'.format(i), 'test')
+
+        form = AddItemForm({'name': 'Laptop', 'returnable': True, 'quantity': 3})
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual([len(message.bcc) for message in mail.outbox], [2, 2, 1])
+        self.assertEqual(mail.outbox[0].to, [])
+
+
+class AdminDigestTestCase(TestCase):
+    """TestCase for admins taking a digest instead of a cc on every notification"""
+
+    def setUp(self):
+        """Creating an admin taking cc, an admin taking a digest and pending requests"""
+        User.objects.create_user('cc@test.com', 'test', is_admin=True)
+        User.objects.create_user('digest@test.com', 'test', is_admin=True, admin_digest=True)
+        self.user = User.objects.create_user('test@test.com', 'test')
+        self.item = Item.objects.create(name='Laptop', returnable=True, quantity=10)
+
+        for i in range(3):
+            Provision.objects.create(item=self.item, user=self.user)
+
+    def test_digest(self):
+        """Approvals cc only admins without digest, the digest sums them up in one mail"""
+        form = BulkApproveForm({'provisions': list(Provision.objects.values_list('id', flat=True))})
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        dispatch_outbox()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].cc, ['cc@test.com'])
+
+        # Summary comes from one grouped query, events are dropped once flushed
+        self.assertEqual(flush_admin_digest(), 1)
+        self.assertFalse(AdminEvent.objects.exists())
+
+        dispatch_outbox()
+        self.assertEqual(mail.outbox[1].to, ['digest@test.com'])
+        self.assertIn('Requests approved - Laptop: 3 time(s), quantity 3', mail.outbox[1].body)
+
+        # Nothing happened since, no digest is sent
+        self.assertEqual(flush_admin_digest(), 0)
+
+    def test_admins_cached(self):
+        """Admin recipients are looked up once until a user changes"""
+        self.assertEqual(sorted(admin_emails()), ['cc@test.com', 'digest@test.com'])
+
+        with self.assertNumQueries(0):
+            admin_emails()
+
+        User.objects.filter(email='digest@test.com').update(is_admin=False)
+        User.objects.get(email='digest@test.com').save()
+        self.assertEqual(admin_emails(), ['cc@test.com'])
+
+
+class TaskMetricsTestCase(TestCase):
+    """TestCase for metrics recorded by task signals"""
+
+    def setUp(self):
+        """Starting from empty counters"""
+        cache.clear()
+
+    def test_task_metrics(self):
+        """Runs and failures of tasks show up in the Prometheus dump"""
+        send_mail_task.delay({'subject': 'Test', 'body': 'Test', 'to': ['test@test.com'], 'cc': []})
+
+        self.assertTrue(send_mail_task.delay({}).failed())
+
+        out = StringIO.StringIO()
+        err = StringIO.StringIO()
+        call_command('task_metrics', stdout=out, stderr=err)
+        dump = out.getvalue()
+
+        # Tests run on a cache kept in the process, which only covers this process
+        self.assertIn('metrics only cover this process', err.getvalue())
+
+        self.assertIn('inventory_task_run_seconds_count{task="send_mail_task"} 2', dump)
+        self.assertIn('inventory_task_run_seconds_bucket{task="send_mail_task",le="+Inf"} 2', dump)
+        self.assertIn('inventory_task_failures_total{task="send_mail_task"} 1', dump)
+        self.assertIn('inventory_task_run_seconds_count{task="run_report_job"} 0', dump)
+
+
+class TaskRoutingTestCase(TestCase):
+    """TestCase for the queues tasks are routed to"""
+
+    def test_routes(self):
+        """Notifications and bulk work go to separate queues"""
+        def queue(task_name):
+            return current_app.amqp.router.route({}, task_name)['queue'].name
+
+        self.assertEqual(queue('send_mail_task'), 'notifications')
+        self.assertEqual(queue('dispatch_outbox_task'), 'notifications')
+        self.assertEqual(queue('run_report_job'), 'bulk')
+        self.assertEqual(queue('mail_report_task'), 'bulk')
+        self.assertEqual(queue('send_announcement_task'), 'bulk')
+
+    def test_queue_worker_options(self):
+        """A worker consuming one queue takes its concurrency and prefetch from settings"""
+        worker = type('Worker', (object,), {'app': current_app})()
+        queues = current_app.amqp.queues
+
+        try:
+            queues.select(['bulk'])
+            QueueWorkerOptions(worker)
+            self.assertEqual((worker.concurrency, worker.prefetch_multiplier), (2, 1))
+
+            # Concurrency given on the command line wins
+            worker.concurrency = 6
+            QueueWorkerOptions(worker, concurrency=6)
+            self.assertEqual(worker.concurrency, 6)
+
+        finally:
+            queues._consume_from = None
+
+
+class SharedCacheCheckTestCase(TestCase):
+    """TestCase for the check of the cache shared by all processes"""
+
+    def test_process_local_cache(self):
+        """A cache kept in each process is reported, a shared one is not"""
+        self.assertEqual([warning.id for warning in check_shared_cache(None)], ['inventory.W001'])
+
+        with override_settings(CACHES={'default': {'BACKEND': 'django_redis.cache.RedisCache'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class PendingGenerationsTestCase(TestCase):
+    """TestCase for cache generations bumped again once transactions committed"""
+
+    def setUp(self):
+        """Creating a user and an item to provision"""
+        cache.clear()
+
+        self.user = User.objects.create_user('test@test.com', 'test')
+        self.item = Item.objects.create(name='Laptop', returnable=True, quantity=10)
+
+    def test_report_dropped_after_request(self):
+        """A report cached before a change committed is dropped once the request ended"""
+        with transaction.atomic():
+            Provision.objects.create(
+                item=self.item,
+                user=self.user,
+                approved=True,
+                approved_on=datetime.now(),
+                quantity=1
+            )
+
+            # Read by a concurrent request before the change committed
+            get_cached_report({}, lambda: {'data': []})
+
+        self.assertEqual(get_cached_report({}, lambda: {'data': ['fresh']}), {'data': []})
+
+        self.client.get(reverse_lazy('login'))
+
+        self.assertEqual(get_cached_report({}, lambda: {'data': ['fresh']}), {'data': ['fresh']})
+
+    def test_dashboards_bumped_after_request(self):
+        """Dashboards cached before an approval committed are rendered again once the request ended"""
+        provision = Provision.objects.create(item=self.item, user=self.user)
+        scopes = ('admin', 'user:{0}'.format(self.user.id))
+
+        with transaction.atomic():
+            form = ProvisionItemByRequestForm({'item': self.item.id}, instance=provision)
+            self.assertTrue(form.is_valid())
+            form.save()
+
+            # Versions a concurrent load would cache the tables under before the commit
+            versions = [dashboard_cache_version(scope) for scope in scopes]
+
+        self.client.get(reverse_lazy('login'))
+
+        for scope, version in zip(scopes, versions):
+            self.assertNotEqual(dashboard_cache_version(scope), version)
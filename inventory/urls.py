@@ -14,11 +14,15 @@ from inventory.views import (
     RequestItemView,
     ProvisionListView,
     ReturnItemView,
+    BulkReturnView,
     ProvisionItemView,
     ProvisionByRequestView,
+    BulkApproveView,
     EditItemListView,
     LoadMoreView, ImageUploadView, UserAutocompleteView,
-    ItemAutocompleteView, ReportView, ReportAjaxView, LoginFormView)
+    ItemAutocompleteView, ReportView, ReportAjaxView, ReportDownloadView,
+    ReportJobsView, ReportJobView, ReportJobDownloadView,
+    LoginFormView)
 from inventory.decorators import (
     admin_required,
     anonymous_required
@@ -112,6 +116,13 @@ urlpatterns = patterns(
         ),
         name='return_item'
     ),
+    url(
+        r'^items/return/bulk/$',
+        admin_required(
+            BulkReturnView.as_view()
+        ),
+        name='bulk_return'
+    ),
     url(
         r'^items/provision/$',
         admin_required(
@@ -126,6 +137,13 @@ urlpatterns = patterns(
         ),
         name='provision_by_request'
     ),
+    url(
+        r'^items/provision/approve/$',
+        admin_required(
+            BulkApproveView.as_view()
+        ),
+        name='bulk_approve'
+    ),
     url(
         r'^report/$',
         admin_required(
@@ -140,6 +158,34 @@ urlpatterns = patterns(
         ),
         name='report_ajax'
     ),
+    url(
+        r'^report/jobs/$',
+        admin_required(
+            ReportJobsView.as_view()
+        ),
+        name='report_jobs'
+    ),
+    url(
+        r'^report/jobs/(?P<pk>\d+)/$',
+        admin_required(
+            ReportJobView.as_view()
+        ),
+        name='report_job'
+    ),
+    url(
+        r'^report/jobs/(?P<pk>\d+)/download/$',
+        admin_required(
+            ReportJobDownloadView.as_view()
+        ),
+        name='report_job_download'
+    ),
+    url(
+        r'^report/download/$',
+        admin_required(
+            ReportDownloadView.as_view()
+        ),
+        name='report_download'
+    ),
 
     # urls for user role (but admin can also access)
     url(
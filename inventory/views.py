@@ -1,18 +1,19 @@
 """Inventory app views"""
-from datetime import datetime
-import time
-
+from django.conf import settings
 from django.contrib import auth, messages
 from django.contrib.auth.forms import PasswordChangeForm
-from django.core.urlresolvers import reverse_lazy
-from django.db.models import Sum, Q
+from django.core.urlresolvers import reverse, reverse_lazy
+from django.db import transaction
 from django.forms import formset_factory
 from django.http import (
+    FileResponse,
     HttpResponseRedirect,
     Http404,
-    JsonResponse
+    JsonResponse,
+    StreamingHttpResponse
 )
 from django.shortcuts import get_object_or_404
+from django.utils.functional import cached_property
 from django.views.generic import (
     View,
     RedirectView,
@@ -27,6 +28,8 @@ from django.views.generic import (
 from inventory.models import (
     Provision,
     Item,
+    OutOfStock,
+    ReportJob,
     User
 )
 from inventory.forms import (
@@ -36,14 +39,31 @@ from inventory.forms import (
     RequestItemForm,
     ProvisionItemForm,
     ProvisionItemByRequestForm,
+    BulkApproveForm,
+    BulkReturnForm,
     ReturnItemForm,
     ImageUploadForm,
     DateFilterForm,
     LoginForm,
     ProvisionFormset
 )
+from inventory.caching import dashboard_cache_version, get_generation
 from inventory.message_constants import *
-from inventory.tasks import send_report
+from inventory.pagination import encode_cursor, keyset_page
+from inventory.reports import (
+    get_cached_report,
+    get_report_filters,
+    get_report_queryset,
+    get_report_storage,
+    iter_report_csv,
+    iter_report_ndjson,
+    iter_report_rows,
+    order_report_queryset,
+    parse_int,
+    report_file_type,
+    report_row
+)
+from inventory.tasks import mail_report_task, run_report_job
 
 from dal import autocomplete
 
@@ -120,6 +140,38 @@ class LogoutView(RedirectView):
         return HttpResponseRedirect(url)
 
 
+class DashboardTable(object):
+    """Rows of a dashboard table, fetched when the template first reads them"""
+
+    def __init__(self, queryset, size=5):
+        self.queryset = queryset
+        self.size = size
+
+    @cached_property
+    def rows(self):
+        """Fetching one row more than shown tells if more items are remaining"""
+        return list(self.queryset[:self.size + 1])
+
+    def __iter__(self):
+        return iter(self.rows[:self.size])
+
+    def __len__(self):
+        return min(len(self.rows), self.size)
+
+    def __getitem__(self, index):
+        return self.rows[:self.size][index]
+
+    @property
+    def more(self):
+        """Boolean to mark if more items are remaining for the table"""
+        return len(self.rows) > self.size
+
+    @property
+    def cursor(self):
+        """Cursor to load the rows after the shown ones"""
+        return encode_cursor(self.rows[self.size - 1]) if self.more else ''
+
+
 class DashboardView(TemplateView):
     """
     View for dashboard page
@@ -131,7 +183,9 @@ class DashboardView(TemplateView):
         Fetching pending and approved requests for context
         """
         user = self.request.user
-        provisions = Provision.objects.filter(returned=False)
+        provisions = Provision.objects.filter(
+            returned=False
+        ).select_related('item', 'user')
 
         # Assign admin the role of user, if requested
         is_admin = True if user.is_admin and not self.request.GET.get('user', False) else False
@@ -139,34 +193,30 @@ class DashboardView(TemplateView):
         # Collecting data for pending and approved requests
         pending = provisions.filter(
             approved=False
-        ).order_by('timestamp') if is_admin else provisions.filter(
+        ).order_by('timestamp', 'id') if is_admin else provisions.filter(
             user=user,
             approved=False
-        ).order_by('timestamp')
+        ).order_by('timestamp', 'id')
 
         approved = provisions.filter(
             approved=True,
             returned=False
-        ).order_by('-timestamp') if is_admin else provisions.filter(
+        ).order_by('-timestamp', '-id') if is_admin else provisions.filter(
             user=user,
             approved=True
-        ).order_by('-timestamp')
+        ).order_by('-timestamp', '-id')
 
-        # Boolean variables for mark if more items are remaining for tables
-        pending_more = True if pending.count() > 5 else False
-        approved_more = True if approved.count() > 5 else False
-
-        # Limiting the items lists for 5 items each
-        pending = pending[:5]
-        approved = approved[:5]
+        # Tables are only queried if their cached fragments are missing
+        scope = 'admin' if is_admin else 'user:{0}'.format(user.id)
 
         # Preparing context and returning it
         context = {
             'is_admin': is_admin,
-            'pending': pending,
-            'approved': approved,
-            'pending_more': pending_more,
-            'approved_more': approved_more
+            'pending': DashboardTable(pending),
+            'approved': DashboardTable(approved),
+            'cache_timeout': settings.DASHBOARD_CACHE_TIMEOUT,
+            'cache_scope': scope,
+            'cache_version': dashboard_cache_version(scope)
         }
 
         return context
@@ -361,15 +411,36 @@ class ProvisionListView(ListView):
 
     model = Provision
     template_name = 'provision_list.html'
+    paginate_by = 50
 
     def get_queryset(self):
         """
         Changing queryset to view only non returned provisions
         """
-        self.queryset = self.model.objects.filter(returned=False, approved=True)
+        self.queryset = self.model.objects.filter(
+            returned=False,
+            approved=True
+        ).select_related('item', 'user').order_by('timestamp', 'id')
         return super(ProvisionListView, self).get_queryset()
 
 
+class BulkReturnView(View):
+    """View for marking many provisions returned at once"""
+
+    def post(self, request):
+        """Mark the selected provisions returned"""
+        form = BulkReturnForm(request.POST)
+
+        if not form.is_valid():
+            messages.error(request, NO_PROVISIONS_SELECTED_MESSAGE)
+            return HttpResponseRedirect(reverse_lazy('provision_list'))
+
+        returned = form.save()
+        messages.success(request, bulk_return_message(len(returned)))
+
+        return HttpResponseRedirect(reverse_lazy('provision_list'))
+
+
 class ReturnItemView(UpdateView):
     """
     View for returning item
@@ -385,7 +456,7 @@ class ReturnItemView(UpdateView):
         """
         pk = self.kwargs.get(self.pk_url_kwarg)
         obj = get_object_or_404(
-            Provision,
+            Provision.objects.select_related('item', 'user'),
             id=pk,
             approved=True,
             returned=False,
@@ -416,8 +487,12 @@ class ProvisionItemView(FormView):
         """
         If the form is valid, redirect to the supplied URL.
         """
-        for form in formset:
-            form.save()
+        try:
+            formset.save()
+
+        except OutOfStock as error:
+            formset._non_form_errors.append(out_of_stock_message(error.item.name))
+            return self.form_invalid(formset)
 
         messages.success(
             self.request,
@@ -442,10 +517,12 @@ class ProvisionItemView(FormView):
         ProvisionItemFormset = formset_factory(ProvisionItemForm, formset=ProvisionFormset)
         formset = ProvisionItemFormset(request.POST, request.FILES)
 
-        if formset.is_valid():
-            return self.form_valid(formset)
-        else:
-            return self.form_invalid(formset)
+        # Items locked while validating stay locked until provisions are saved
+        with transaction.atomic():
+            if formset.is_valid():
+                return self.form_valid(formset)
+            else:
+                return self.form_invalid(formset)
 
 
 class ProvisionByRequestView(UpdateView):
@@ -464,6 +541,13 @@ class ProvisionByRequestView(UpdateView):
 
     def form_valid(self, form):
         """Pass success message when form is validated"""
+        try:
+            response = super(ProvisionByRequestView, self).form_valid(form)
+
+        except OutOfStock as error:
+            form.add_error(None, out_of_stock_message(error.item.name))
+            return self.form_invalid(form)
+
         messages.success(
             self.request,
             item_provision_message(
@@ -472,79 +556,127 @@ class ProvisionByRequestView(UpdateView):
             )
         )
 
-        return super(ProvisionByRequestView, self).form_valid(form)
+        return response
+
+
+class BulkApproveView(View):
+    """View for approving many pending requests from the dashboard at once"""
+
+    def post(self, request):
+        """Approve the selected requests, report the ones left for lack of stock or approved already"""
+        form = BulkApproveForm(request.POST)
+
+        if not form.is_valid():
+            messages.error(request, NO_REQUESTS_SELECTED_MESSAGE)
+            return HttpResponseRedirect(reverse_lazy('dashboard'))
+
+        approved, failed, skipped = form.save()
+
+        if approved:
+            messages.success(request, bulk_approve_message(len(approved)))
+
+        if failed:
+            messages.error(
+                request,
+                bulk_approve_failed_message(
+                    (provision.item.name, provision.user.email) for provision in failed
+                )
+            )
+
+        if skipped:
+            messages.warning(
+                request,
+                bulk_approve_skipped_message(
+                    (provision.item.name, provision.user.email) for provision in skipped
+                )
+            )
+
+        return HttpResponseRedirect(reverse_lazy('dashboard'))
 
 
 class LoadMoreView(View):
-    """View to load more provisions in the dashboard via ajax"""
+    """View to load more provisions in the dashboard via ajax, a page at a time"""
+
+    page_size = 20
 
     def get(self, request):
         if request.is_ajax():
             """Process AJAX request and send required data"""
             load_more_pending = request.GET.get('load_more_pending', False)
             load_more_approved = request.GET.get('load_more_approved', False)
+            cursor = request.GET.get('cursor', '')
 
-            provisions = Provision.objects.filter(returned=False)
+            provisions = Provision.objects.filter(
+                returned=False
+            ).select_related('item', 'user')
 
             is_admin = request.user.is_admin and self.request.GET.get('is_admin', False) == 'True'
 
             pending = provisions.filter(
                 approved=False,
-            ).order_by('timestamp') if is_admin else provisions.filter(
+            ) if is_admin else provisions.filter(
                 user=self.request.user,
                 approved=False
-            ).order_by('timestamp')
+            )
 
             approved = provisions.filter(
                 approved=True,
                 returned=False
-            ).order_by('-timestamp') if is_admin else provisions.filter(
+            ) if is_admin else provisions.filter(
                 user=self.request.user,
                 approved=True
-            ).order_by('-timestamp')
+            )
 
-            pending = pending[5:]
-            approved = approved[5:]
+            try:
+                # Load more pending requests
+                if load_more_pending:
+                    p_list, next_cursor = keyset_page(pending, cursor, self.page_size)
+                    p_dict = {
+                        'pending': [],
+                        'next_cursor': next_cursor
+                    }
 
-            # Load more pending requests
-            if load_more_pending:
-                p_list = list(pending)
-                p_dict = {
-                    'pending': []
-                }
+                    for p in p_list:
+                        description = p.item.description or ''
+                        p_dict['pending'].append({
+                            'item_name': p.item.name,
+                            'description': (description[:75] + '...') if len(
+                                description) > 75 else description,
+                            'timestamp': p.timestamp.strftime("%d %b %y"),
+                            'user_email': str(p.user),
+                            'provision_id': p.id
+                        })
+
+                    return JsonResponse(p_dict)
+
+                # Load more approved requests
+                if load_more_approved:
+                    a_list, next_cursor = keyset_page(approved, cursor, self.page_size, descending=True)
+                    a_dict = {
+                        'approved': [],
+                        'next_cursor': next_cursor
+                    }
 
-                for p in p_list:
-                    p_dict['pending'].append({
-                        'item_name': p.item.name,
-                        'description': (p.item.description[:75] + '...') if len(
-                            p.item.description) > 75 else p.item.description,
-                        'timestamp': p.timestamp.strftime("%d %b %y"),
-                        'user_email': str(p.user),
-                        'provision_id': p.id
-                    })
-
-                return JsonResponse(p_dict)
-
-            # Load more approved requests
-            if load_more_approved:
-                a_list = list(approved)
-                a_dict = {
-                    'approved': []
-                }
+                    for a in a_list:
+                        description = a.item.description or ''
+                        a_dict['approved'].append({
+                            'provision_id': a.id,
+                            'item_name': a.item.name,
+                            'description': (description[:75] + '...') if len(
+                                description) > 75 else description,
+                            'returnable': 'Yes' if a.item.returnable else 'No',
+                            'return_by': a.return_by.strftime("%d %b %y") if a.return_by else 'N/A',
+                            'user_email': str(a.user),
+                            'returned': 'Yes' if a.returned else 'No' if a.item.returnable else 'N/A',
+                        })
+
+                    return JsonResponse(a_dict)
 
-                for a in a_list:
-                    a_dict['approved'].append({
-                        'provision_id': a.id,
-                        'item_name': a.item.name,
-                        'description': (a.item.description[:75] + '...') if len(
-                            a.item.description) > 75 else a.item.description,
-                        'returnable': 'Yes' if a.item.returnable else 'No',
-                        'return_by': a.return_by.strftime("%d %b %y") if a.return_by else 'N/A',
-                        'user_email': str(a.user),
-                        'returned': 'Yes' if a.returned else 'No' if a.item.returnable else 'N/A',
-                    })
+            except ValueError:
+                # Malformed cursor
+                raise Http404()
 
-                return JsonResponse(a_dict)
+        raise Http404()
 
 
 class ImageUploadView(UpdateView):
@@ -616,6 +748,32 @@ class ItemAutocompleteView(autocomplete.Select2QuerySetView):
         return qs
 
 
+def start_report_job(params, user):
+    """Start a report job for request parameters, or return the identical one"""
+    job, created = ReportJob.objects.get_or_create_for(
+        get_report_filters(params),
+        user,
+        get_generation('report'),
+        settings.REPORT_JOB_TIMEOUT
+    )
+
+    if created:
+        run_report_job.delay(job.id)
+
+    return job
+
+
+def report_job_data(job):
+    """Status of a report job with its links, as polled by the report page"""
+    data = job.get_progress()
+    data['status_url'] = reverse('report_job', args=[job.id])
+
+    if job.status == ReportJob.DONE:
+        data['download_url'] = reverse('report_job_download', args=[job.id])
+
+    return data
+
+
 class ReportView(TemplateView):
     template_name = 'report.html'
 
@@ -624,12 +782,20 @@ class ReportView(TemplateView):
             kwargs['view'] = self
         if 'form' not in kwargs:
             kwargs['form'] = DateFilterForm()
+        if 'jobs' not in kwargs:
+            # Finished reports, downloaded again without generating them
+            kwargs['jobs'] = ReportJob.objects.filter(
+                status=ReportJob.DONE
+            ).select_related('requested_by').order_by('-finished_on')[:10]
         return kwargs
 
 
 class ReportAjaxView(View):
     """View to handle AJAX requests by Report page"""
 
+    # Most rows served in a page, as the largest page DataTables offers
+    max_page_length = 100
+
     def get(self, request):
         """Get request responds the items data for report table"""
         if request.is_ajax():
@@ -639,12 +805,23 @@ class ReportAjaxView(View):
             start_date = request.GET.get('sd', '')
             end_date = request.GET.get('ed', '')
 
-            json_data = self.get_report_data(
-                returnable,
-                non_returnable,
-                start_date,
-                end_date
-            )
+            # DataTables in server-side processing mode asks for one page
+            if 'draw' in request.GET:
+                json_data = self.get_report_page(
+                    request.GET,
+                    returnable,
+                    non_returnable,
+                    start_date,
+                    end_date
+                )
+
+            else:
+                json_data = self.get_report_data(
+                    returnable,
+                    non_returnable,
+                    start_date,
+                    end_date
+                )
 
             return JsonResponse(json_data)
 
@@ -652,89 +829,183 @@ class ReportAjaxView(View):
             raise Http404()
 
     def post(self, request):
-
+        """Post request queues the report to be generated and mailed by a worker"""
         if request.is_ajax():
-            # Saving the POST variables to filter data
-            returnable = request.POST.get('r')
-            non_returnable = request.POST.get('nr')
-            start_date = request.POST.get('sd', '')
-            end_date = request.POST.get('ed', '')
-            keyword = request.POST.get('kw', '')
-
-            csv = self.get_report_data(
+            job = start_report_job(request.POST, request.user)
+            mail_report_task.delay(job.id, request.user.email)
+
+            resp = report_job_data(job)
+            resp['message'] = REPORT_QUEUED_MESSAGE
+
+            return JsonResponse(resp)
+
+        else:
+            raise Http404()
+
+    def get_report_data(self, returnable, non_returnable, start_date, end_date, keyword=''):
+        """Generate data to give in report, served from cache when possible"""
+        params = {
+            'r': returnable,
+            'nr': non_returnable,
+            'sd': start_date,
+            'ed': end_date,
+            'kw': keyword
+        }
+
+        def generate():
+            rows = get_report_queryset(
                 returnable,
                 non_returnable,
                 start_date,
                 end_date,
                 keyword
-            )['data']
+            )
 
-            if csv:
-                csv = {'csv': csv}
-                send_report.delay(csv, request.user.email)
+            return {
+                'data': [report_row(row) for row in rows]
+            }
 
-                resp = {
-                    'message': 'Mail sent'
-                }
+        return get_cached_report(params, generate)
+
+    def get_report_page(self, params, returnable, non_returnable, start_date, end_date):
+        """Generate a page of report data for DataTables server-side processing"""
+        start = max(parse_int(params.get('start'), 0), 0)
+        length = parse_int(params.get('length'), 25)
+
+        # Length of -1 asks for all rows, served as the largest page instead
+        if length < 0 or length > self.max_page_length:
+            length = self.max_page_length
+        keyword = params.get('search[value]', '').strip()
+
+        # Resolving the ordered column from its index in the table
+        column = params.get('columns[{0}][data]'.format(
+            parse_int(params.get('order[0][column]'), 0)
+        ))
+        direction = params.get('order[0][dir]', 'asc')
+
+        page_params = {
+            'r': returnable,
+            'nr': non_returnable,
+            'sd': start_date,
+            'ed': end_date,
+            'kw': keyword,
+            'start': start,
+            'length': length,
+            'order': [column, direction]
+        }
 
-            else:
-                resp = {
-                    'message': 'No data to send'
-                }
+        json_data = get_cached_report(
+            page_params,
+            lambda: self.generate_report_page(
+                returnable,
+                non_returnable,
+                start_date,
+                end_date,
+                keyword,
+                start,
+                length,
+                column,
+                direction
+            )
+        )
 
-            return JsonResponse(resp)
+        # Draw counter is echoed back as is, it is not part of the cache key
+        json_data['draw'] = parse_int(params.get('draw'), 0)
+
+        return json_data
+
+    def generate_report_page(self, returnable, non_returnable, start_date, end_date, keyword,
+                             start, length, column, direction):
+        """Query a page of report data along with the total and filtered row counts"""
+        rows = get_report_queryset(
+            returnable,
+            non_returnable,
+            start_date,
+            end_date
+        )
+        total = rows.count()
+
+        if keyword:
+            rows = get_report_queryset(
+                returnable,
+                non_returnable,
+                start_date,
+                end_date,
+                keyword
+            )
+            filtered = rows.count()
+
+        else:
+            filtered = total
+
+        rows = order_report_queryset(rows, column, direction)[start:start + length]
+
+        json_data = {
+            'recordsTotal': total,
+            'recordsFiltered': filtered,
+            'data': [report_row(row) for row in rows]
+        }
+
+        return json_data
+
+
+class ReportJobsView(View):
+    """View to start report jobs"""
+
+    def post(self, request):
+        """Post request starts a report job, identical requests share one job"""
+        if request.is_ajax():
+            return JsonResponse(report_job_data(start_report_job(request.POST, request.user)))
 
         else:
             raise Http404()
 
-    def get_report_data(self, returnable, non_returnable, start_date, end_date, keyword=''):
-        """Generate data to give in report"""
 
-        try:
-            start_date = datetime.fromtimestamp(
-                time.mktime(time.strptime(start_date, "%Y-%m-%d"))
-            )
+class ReportJobView(View):
+    """View polled by the report page while a report job runs"""
 
-        except ValueError:
-            start_date = datetime.fromtimestamp(0)
+    def get(self, request, pk):
+        """Get request responds the status of a report job"""
+        if request.is_ajax():
+            return JsonResponse(report_job_data(get_object_or_404(ReportJob, pk=pk)))
 
-        try:
-            end_date = datetime.fromtimestamp(
-                time.mktime(time.strptime(end_date, "%Y-%m-%d"))
-            )
+        else:
+            raise Http404()
 
-        except ValueError:
-            end_date = datetime.now()
 
-        # Creating filters for items
-        Q_set = Q(name__icontains=keyword) | Q(description__icontains=keyword)
+class ReportJobDownloadView(View):
+    """View to download the report file of a finished job"""
 
-        if returnable and not non_returnable:
-            Q_set &= Q(returnable=True)
+    def get(self, request, pk):
+        """Serve the report file as it was generated"""
+        job = get_object_or_404(ReportJob, pk=pk, status=ReportJob.DONE)
+        filename, content_type = report_file_type(job.artifact)
 
-        elif non_returnable and not returnable:
-            Q_set &= Q(returnable=False)
+        response = FileResponse(get_report_storage().open(job.artifact), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
 
-        items = Item.objects.filter(Q_set)
-        json_data = {
-            'data': []
-        }
+        return response
 
-        for item in items:
-            provisions_for_item = Provision.objects.filter(
-                item=item,
-                approved_on__gte=start_date,
-                approved_on__lt=end_date
-            )
 
-            if provisions_for_item.count():
-                quantity = provisions_for_item.aggregate(Sum('quantity')).get('quantity__sum')
-                row = {
-                    'name': item.name,
-                    'description': item.description,
-                    'returnable': 'Yes' if item.returnable else 'No',
-                    'quantity': quantity
-                }
-                json_data['data'].append(row)
+class ReportDownloadView(View):
+    """View to stream the report as a file download"""
+
+    formats = {
+        'csv': (iter_report_csv, 'text/csv', 'Report.csv'),
+        'ndjson': (iter_report_ndjson, 'application/x-ndjson', 'Report.ndjson'),
+    }
+
+    def get(self, request):
+        """Stream report rows as they are read from the database"""
+        try:
+            serializer, content_type, filename = self.formats[request.GET.get('format', 'csv')]
+
+        except KeyError:
+            raise Http404()
+
+        rows = iter_report_rows(get_report_filters(request.GET))
+
+        response = StreamingHttpResponse(serializer(rows), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
 
-        return json_data
\ No newline at end of file
+        return response
@@ -2,7 +2,7 @@ from __future__ import absolute_import
 
 import os
 
-from celery import Celery
+from celery import Celery, bootsteps
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project_name.settings')
@@ -17,6 +17,27 @@ app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
 
+class QueueWorkerOptions(bootsteps.Step):
+    """Apply CELERY_QUEUE_WORKERS to a worker consuming a single queue"""
+
+    def __init__(self, worker, concurrency=None, **kwargs):
+        super(QueueWorkerOptions, self).__init__(worker, **kwargs)
+
+        queues = list(worker.app.amqp.queues.consume_from)
+        options = settings.CELERY_QUEUE_WORKERS.get(queues[0]) if len(queues) == 1 else None
+
+        if not options:
+            return
+
+        # Runs before the pool and the consumer are created, concurrency
+        # given on the command line wins
+        if not concurrency:
+            worker.concurrency = options['concurrency']
+        worker.prefetch_multiplier = options['prefetch_multiplier']
+
+app.steps['worker'].add(QueueWorkerOptions)
+
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
\ No newline at end of file
@@ -1,12 +1,14 @@
 """Common settings and globals."""
 
 
+from datetime import timedelta
 from os.path import abspath, basename, dirname, join, normpath
 
 
 ########## PATH CONFIGURATION
 # Absolute filesystem path to the Django project directory:
 from django.core.urlresolvers import reverse_lazy
+from kombu import Queue
 
 BASE_DIR = dirname(abspath(__file__))
 ########## END PATH CONFIGURATION
@@ -147,6 +149,9 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+
+    # Invalidates caches again once the transactions of a request committed.
+    'inventory.middleware.PendingGenerationsMiddleware',
 )
 ########## END MIDDLEWARE CONFIGURATION
 
@@ -195,15 +200,57 @@ INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
 ########## CACHE CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
+# Shared by the web and worker processes, cached reports, dashboards, admin
+# recipients and task metrics are invalidated and counted across all of them
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'project-default'
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        }
     }
 }
 ########## END CACHE CONFIGURATION
 
 
+########## REPORT CONFIGURATION
+# Seconds a generated report stays cached, cached reports are also
+# dropped as soon as an item or a provision changes
+REPORT_CACHE_TIMEOUT = 60 * 60
+
+# Report jobs are aggregated in parallel, in ranges of this many item ids
+REPORT_CHUNK_ITEMS = 500
+
+# Where workers write report chunks and the report files of jobs, shared by
+# all of them and kept out of MEDIA_ROOT so reports are never served publicly
+REPORT_FILES_ROOT = normpath(join(BASE_DIR, 'reports'))
+
+# Compression level of report files, from 1, fastest, to 9, smallest
+REPORT_COMPRESSION_LEVEL = 6
+
+# Reports with a larger compressed file are mailed as a download link
+REPORT_ATTACHMENT_MAX_SIZE = 5 * 1024 * 1024
+
+# Scheme and host the download links of mailed reports point to, without a trailing slash
+REPORT_LINK_BASE_URL = 'http://localhost:8000'
+
+# Seconds after which a report job still running is taken as lost,
+# identical requests then start a new job
+REPORT_JOB_TIMEOUT = 60 * 60
+
+# Seconds between two checks of a report job waiting to be mailed
+REPORT_MAIL_POLL_INTERVAL = 10
+########## END REPORT CONFIGURATION
+
+
+########## DASHBOARD CONFIGURATION
+# Seconds the dashboard tables stay cached, they are also versioned
+# so a change to a shown provision or item renders them again
+DASHBOARD_CACHE_TIMEOUT = 60 * 60 * 24
+########## END DASHBOARD CONFIGURATION
+
+
 ########## EMAIL CONFIGURATION
 # EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 #
@@ -214,9 +261,45 @@ CACHES = {
 # DEFAULT_FROM_EMAIL = 'webmaster.default@example.com'
 #
 # EMAIL_USE_TLS = True
+
+# Seconds a worker keeps its SMTP connection open without sending,
+# it is opened again afterwards as servers drop idle connections
+EMAIL_CONNECTION_MAX_IDLE = 60
+
+# Users mailed per message when announcing to everyone, kept under the
+# recipient limit of SMTP servers, every chunk is sent by its own task
+ANNOUNCEMENT_CHUNK_SIZE = 50
+
+# Seconds the admin recipients of notifications stay cached, they are
+# also dropped as soon as a user changes
+ADMIN_RECIPIENTS_CACHE_TIMEOUT = 60 * 60
 ########## END EMAIL CONFIGURATION
 
 
+########## OUTBOX CONFIGURATION
+# Notifications are queued in the outbox table by the transaction causing
+# them and sent by the dispatch_outbox_task, scheduled below
+OUTBOX_BATCH_SIZE = 100
+
+# Seconds a dispatcher may hold a batch, then unsent mails are due again
+OUTBOX_LEASE = 5 * 60
+
+# A failed mail is retried after this many seconds, doubled every attempt
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_MAX_ATTEMPTS = 5
+
+# Mails sent per second at most, 0 for no limit
+OUTBOX_RATE_LIMIT = 0
+########## END OUTBOX CONFIGURATION
+
+
+########## ADMIN DIGEST CONFIGURATION
+# Minutes between digest mails of admins who chose a digest over a cc on
+# every provision, approval and return
+ADMIN_DIGEST_INTERVAL = 30
+########## END ADMIN DIGEST CONFIGURATION
+
+
 ########## SESSION
 SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 ########## END SESSION
@@ -283,4 +366,45 @@ CELERY_RESULT_BACKEND = 'redis://localhost:6379'
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TIMEZONE = 'Asia/Kolkata'
\ No newline at end of file
+CELERY_TIMEZONE = 'Asia/Kolkata'
+CELERYBEAT_SCHEDULE = {
+    'dispatch-outbox': {
+        'task': 'dispatch_outbox_task',
+        'schedule': timedelta(seconds=10),
+    },
+    'flush-admin-digest': {
+        'task': 'flush_admin_digest_task',
+        'schedule': timedelta(minutes=ADMIN_DIGEST_INTERVAL),
+    },
+}
+
+# Time-sensitive notifications and bulk work (reports, announcements) go to
+# their own queues, so a large report never holds up a notification. Run a
+# worker per queue and scale each on its own:
+#
+#     celery -A project_name worker -Q notifications -n notifications@%h
+#     celery -A project_name worker -Q bulk -n bulk@%h -Ofair
+CELERY_DEFAULT_QUEUE = 'default'
+CELERY_DEFAULT_ROUTING_KEY = 'default'
+CELERY_QUEUES = (
+    Queue('default', routing_key='default'),
+    Queue('notifications', routing_key='notifications'),
+    Queue('bulk', routing_key='bulk'),
+)
+CELERY_ROUTES = {
+    'send_mail_task': {'queue': 'notifications'},
+    'dispatch_outbox_task': {'queue': 'notifications'},
+    'flush_admin_digest_task': {'queue': 'notifications'},
+    'run_report_job': {'queue': 'bulk'},
+    'report_chunk_task': {'queue': 'bulk'},
+    'merge_report_task': {'queue': 'bulk'},
+    'mail_report_task': {'queue': 'bulk'},
+    'send_announcement_task': {'queue': 'bulk'},
+}
+
+# Concurrency and prefetch of a worker consuming a single queue, unless given
+# on its command line. Bulk workers prefetch nothing beyond the running tasks
+CELERY_QUEUE_WORKERS = {
+    'notifications': {'concurrency': 8, 'prefetch_multiplier': 4},
+    'bulk': {'concurrency': 2, 'prefetch_multiplier': 1},
+}
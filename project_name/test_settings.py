@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from settings import *
 
@@ -11,6 +12,15 @@ DEBUG = True
 COMPRESS_ENABLED = False
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media-test/')
 
+# Tests run in a single process, no Redis is needed
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'project-test'
+    }
+}
+REPORT_FILES_ROOT = os.path.join(tempfile.gettempdir(), 'inventory-reports-test')
+
 # Re assigning because debug_toolbar should not be included while testing
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
@@ -22,4 +32,9 @@ EMAIL_HOST_USER = 'django.inventory@gmail.com'
 EMAIL_HOST_PASSWORD = 'inventoryjtg'
 DEFAULT_FROM_EMAIL = 'Django Inventory App <django.inventory@gmail.com>'
 EMAIL_USE_TLS = True
-########## END EMAIL CONFIGURATION
\ No newline at end of file
+########## END EMAIL CONFIGURATION
+
+########## CELERY CONFIGURATION
+# Run tasks in process while testing, no broker is needed
+CELERY_ALWAYS_EAGER = True
+########## END CELERY CONFIGURATION